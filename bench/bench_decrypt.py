@@ -0,0 +1,43 @@
+# Compare driving gpg directly with forking through pypass, on gpg executors of different sizes
+# Run with `make bench` to use the test gpg key and password store.
+
+import asyncio
+import os
+import sys
+import time
+
+from pass_secret_service.common.pass_store import PassStore
+from pass_secret_service.common.tools import configure_executors, get_executor
+
+
+async def decrypt_all(pass_store, collection_name, names):
+    loop = asyncio.get_running_loop()
+    executor = get_executor("gpg")
+    return await asyncio.gather(*(loop.run_in_executor(executor, pass_store.get_item_password, collection_name, name) for name in names))
+
+
+def bench(path, items, workers):
+    configure_executors(gpg=workers or 4)
+    pass_store = PassStore(path=path, pypass_decrypt=not workers)
+    collection_name = pass_store.create_collection({})
+    try:
+        names = [pass_store.create_item(collection_name, "password{}".format(i), {}) for i in range(items)]
+        start = time.perf_counter()
+        passwords = asyncio.run(decrypt_all(pass_store, collection_name, names))
+        elapsed = time.perf_counter() - start
+        assert passwords == ["password{}".format(i) for i in range(items)]
+    finally:
+        pass_store.delete_collection(collection_name)
+    return elapsed
+
+
+def main():
+    path = os.environ["PASSWORD_STORE_DIR"]
+    items = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    for label, workers in [("pypass (4 workers)", 0), ("gpg pool (2 workers)", 2), ("gpg pool (4 workers)", 4), ("gpg pool (8 workers)", 8)]:
+        elapsed = bench(path, items, workers)
+        print("{:<24} {:>4} items {:8.3f}s {:8.1f} items/s".format(label, items, elapsed, items / elapsed))
+
+
+if __name__ == "__main__":
+    main()
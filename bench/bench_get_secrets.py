@@ -0,0 +1,57 @@
+# Measure GetSecrets for N items with serial and parallel decryption
+# Run with `make bench` to use the test gpg key, password store and a private session bus.
+
+import asyncio
+import os
+import sys
+import time
+
+from dbus_next import Variant
+from dbus_next.aio import MessageBus
+
+from pass_secret_service.common.names import base_path, bus_name
+from pass_secret_service.common.pass_store import PassStore
+from pass_secret_service.interfaces.service import Service
+
+
+async def get_interface(bus, path, interface):
+    introspection = await bus.introspect(bus_name, path)
+    return bus.get_proxy_object(bus_name, path, introspection).get_interface(interface)
+
+
+async def bench(path, items, max_parallel_decrypts):
+    bus = await MessageBus().connect()
+    service = await Service._init(bus, PassStore(path=path), max_parallel_decrypts=max_parallel_decrypts)
+    await bus.request_name(bus_name)
+    client_bus = await MessageBus().connect()
+    try:
+        proxy = await get_interface(client_bus, base_path, "org.freedesktop.Secret.Service")
+        dummy, session_path = await proxy.call_open_session("plain", Variant("s", ""))
+        collection_path, prompt = await proxy.call_create_collection({}, "")
+        collection = await get_interface(client_bus, collection_path, "org.freedesktop.Secret.Collection")
+        item_paths = []
+        for i in range(items):
+            item_path, prompt = await collection.call_create_item({}, [session_path, b"", "password{}".format(i).encode(), "text/plain"], False)
+            item_paths.append(item_path)
+        start = time.perf_counter()
+        secrets = await proxy.call_get_secrets(item_paths, session_path)
+        elapsed = time.perf_counter() - start
+        assert len(secrets) == items
+        await collection.call_delete()
+    finally:
+        client_bus.disconnect()
+        await service._unregister()
+        bus.disconnect()
+    return elapsed
+
+
+def main():
+    path = os.environ["PASSWORD_STORE_DIR"]
+    items = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    for limit in [1, 4, 8, 16]:
+        elapsed = asyncio.run(bench(path, items, limit))
+        print("GetSecrets max_parallel_decrypts={:<3} {:>4} items {:8.3f}s {:8.1f} items/s".format(limit, items, elapsed, items / elapsed))
+
+
+if __name__ == "__main__":
+    main()
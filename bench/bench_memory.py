@@ -0,0 +1,50 @@
+# Measure the memory held per loaded item, with attributes shaped like those of common clients
+# Run with `make bench` to use the test password store.
+
+import asyncio
+import json
+import os
+import sys
+import tracemalloc
+
+from pass_secret_service.common.names import ITEM_ATTRIBUTES, ITEM_LABEL
+from pass_secret_service.common.pass_store import PassStore
+from pass_secret_service.interfaces.collection import Collection
+from pass_secret_service.interfaces.item import Item
+from pass_secret_service.interfaces.service import Service
+
+
+def item_properties(i):
+    # Every item gets its own copies of the strings, like loading them from disk does
+    properties = {
+        ITEM_LABEL: "Password for user{}@example.com".format(i),
+        ITEM_ATTRIBUTES: {
+            "xdg:schema": "org.freedesktop.Secret.Generic" if i % 2 else "org.gnome.keyring.NetworkPassword",
+            "service": "example.com",
+            "username": "user{}@example.com".format(i),
+            "protocol": "https",
+        },
+    }
+    return json.loads(json.dumps(properties))
+
+
+async def load(items):
+    service = Service(None, PassStore(path=os.environ["PASSWORD_STORE_DIR"]))
+    collection = Collection(service, "collection")
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for i in range(items):
+        await Item._init(collection, "{:032x}".format(i), item_properties(i))
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return after - before
+
+
+def main():
+    items = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    used = asyncio.run(load(items))
+    print("{} items {:8.1f} MiB {:8.0f} bytes/item".format(items, used / 2**20, used / items))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+# Measure OpenSession latency with the dh algorithm for a wave of clients, with and without pregenerated keypairs
+# Run with `make bench` to use the test gpg key, password store and a private session bus.
+# The service runs in its own process, so the client does not compete with it for the GIL.
+
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+from dbus_next import Message, Variant
+from dbus_next.aio import MessageBus
+
+from pass_secret_service.common.consts import dh_prime
+from pass_secret_service.common.names import base_path, bus_name
+
+
+async def wait_for_service(bus):
+    for i in range(500):
+        reply = await bus.call(
+            Message(
+                destination="org.freedesktop.DBus",
+                path="/org/freedesktop/DBus",
+                interface="org.freedesktop.DBus",
+                member="NameHasOwner",
+                signature="s",
+                body=[bus_name],
+            )
+        )
+        if reply.body[0]:
+            return
+        await asyncio.sleep(0.01)
+    raise TimeoutError("service did not show up")
+
+
+async def open_session(proxy, pub_key):
+    start = time.perf_counter()
+    await proxy.call_open_session("dh-ietf1024-sha256-aes128-cbc-pkcs7", Variant("ay", pub_key))
+    return time.perf_counter() - start
+
+
+async def bench(path, sessions, dh_pool_size):
+    command = [sys.executable, "-c", "from pass_secret_service.pass_secret_service import main; main()"]
+    service = subprocess.Popen(command + ["--path", path, "--dh-pool-size", str(dh_pool_size)])
+    bus = await MessageBus().connect()
+    try:
+        await wait_for_service(bus)
+        # Let the pool fill up, as it would before the first clients arrive
+        await asyncio.sleep(1 + dh_pool_size * 0.01)
+        introspection = await bus.introspect(bus_name, base_path)
+        proxy = bus.get_proxy_object(bus_name, base_path, introspection).get_interface("org.freedesktop.Secret.Service")
+        pub_key = pow(2, int.from_bytes(os.urandom(0x80), "big"), dh_prime).to_bytes(0x80, "big")
+        latencies = await asyncio.gather(*(open_session(proxy, pub_key) for i in range(sessions)))
+    finally:
+        bus.disconnect()
+        service.terminate()
+        service.wait()
+    return sorted(latencies)
+
+
+def main():
+    path = os.environ["PASSWORD_STORE_DIR"]
+    sessions = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    for label, dh_pool_size in [("cold (no pool)", 0), ("warm (pool of {})".format(sessions), sessions)]:
+        latencies = asyncio.run(bench(path, sessions, dh_pool_size))
+        print(
+            "OpenSession {:<19} {:>4} clients median {:7.3f}ms max {:7.3f}ms".format(
+                label, sessions, latencies[len(latencies) // 2] * 1000, latencies[-1] * 1000
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
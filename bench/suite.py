@@ -0,0 +1,224 @@
+# Benchmark suite for the D-Bus API
+# Builds synthetic stores with the test gpg key, starts the service on each of them in its own process
+# and drives it through dbus_next proxies. Latencies (p50/p99) and throughput per method are written as JSON,
+# so results can be compared across commits.
+# Run with `make bench-suite`, or for a quick run:
+#   dbus-run-session -- python3 -m bench.suite --sizes 1000 --output bench.json
+
+import asyncio
+import click
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+from dbus_next import Message, Variant
+from dbus_next.aio import MessageBus
+
+from pass_secret_service.common.consts import dh_prime
+from pass_secret_service.common.names import base_path, bus_name, collection_interface, COLLECTION_LABEL, ITEM_ATTRIBUTES, ITEM_LABEL
+from pass_secret_service.common.pass_store import PassStore
+
+GROUPS = 100
+
+
+def build_store(path, items):
+    # Encrypts a single password with gpg and copies it to all items, so large stores are built in seconds
+    shutil.copy(os.path.join(os.environ["PASSWORD_STORE_DIR"], ".gpg-id"), path)
+    pass_store = PassStore(path=path)
+    collection_name = pass_store.create_collection({COLLECTION_LABEL: "bench"})
+    collection_path = os.path.join(pass_store.base_path, collection_name)
+    name = pass_store.create_item(collection_name, "password", {})
+    with open(os.path.join(collection_path, name + ".gpg"), "rb") as fp:
+        ciphertext = fp.read()
+    # Backdated like an established store, recent timestamps are never trusted by the manifest
+    mtime = time.time_ns() - 3600 * 10**9
+    for i in range(items):
+        name = name if i == 0 else str(uuid.uuid4()).replace("-", "_")
+        item_path = os.path.join(collection_path, name)
+        with open(item_path + ".gpg", "wb") as fp:
+            fp.write(ciphertext)
+        properties = {ITEM_LABEL: "item{}".format(i), ITEM_ATTRIBUTES: {"group": str(i % GROUPS), "id": str(i)}}
+        with open(item_path + ".properties", "w") as fp:
+            json.dump(properties, fp)
+        os.utime(item_path + ".gpg", ns=(mtime, mtime))
+        os.utime(item_path + ".properties", ns=(mtime, mtime))
+    os.utime(collection_path, ns=(mtime, mtime))
+    pass_store.save_aliases({"default": collection_name})
+
+
+def summarize(latencies, count=None):
+    latencies = sorted(latencies)
+
+    def percentile(q):
+        return latencies[max(math.ceil(q * len(latencies)) - 1, 0)] * 1000
+
+    return {
+        "calls": len(latencies),
+        "p50_ms": round(percentile(0.5), 3),
+        "p99_ms": round(percentile(0.99), 3),
+        "max_ms": round(latencies[-1] * 1000, 3),
+        "per_s": round((count or len(latencies)) / sum(latencies), 1),
+    }
+
+
+async def timed(calls, coro_function):
+    latencies = []
+    for i in range(calls):
+        start = time.perf_counter()
+        await coro_function(i)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+class ServiceProcess:
+    def __init__(self, path, options):
+        self.path = path
+        self.options = options
+
+    async def __aenter__(self):
+        command = [sys.executable, "-c", "from pass_secret_service.pass_secret_service import main; main()"]
+        self.start = time.perf_counter()
+        self.process = subprocess.Popen(command + ["--path", self.path] + self.options)
+        self.bus = await MessageBus().connect()
+        while not await self._has_owner():
+            if self.process.poll() is not None:
+                raise RuntimeError("service exited with {}".format(self.process.returncode))
+            await asyncio.sleep(0.005)
+        # Time to the first answer, which also makes sure the service's main loop is running
+        await self.get_interface(base_path, "org.freedesktop.Secret.Service")
+        self.startup = time.perf_counter() - self.start
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.bus.disconnect()
+        self.process.terminate()
+        self.process.wait()
+
+    async def _has_owner(self):
+        message = Message(
+            destination="org.freedesktop.DBus",
+            path="/org/freedesktop/DBus",
+            interface="org.freedesktop.DBus",
+            member="NameHasOwner",
+            signature="s",
+            body=[bus_name],
+        )
+        return (await self.bus.call(message)).body[0]
+
+    async def get_interface(self, path, interface):
+        introspection = await self.bus.introspect(bus_name, path)
+        return self.bus.get_proxy_object(bus_name, path, introspection).get_interface(interface)
+
+
+async def bench_methods(env, calls, batch):
+    results = {}
+    service = await env.get_interface(base_path, "org.freedesktop.Secret.Service")
+    collection = await env.get_interface(base_path + "/aliases/default", "org.freedesktop.Secret.Collection")
+
+    async def open_plain(i):
+        await service.call_open_session("plain", Variant("s", ""))
+
+    pub_key = pow(2, int.from_bytes(os.urandom(0x80), "big"), dh_prime).to_bytes(0x80, "big")
+
+    async def open_dh(i):
+        await service.call_open_session("dh-ietf1024-sha256-aes128-cbc-pkcs7", Variant("ay", pub_key))
+
+    results["OpenSession(plain)"] = summarize(await timed(calls, open_plain))
+    results["OpenSession(dh)"] = summarize(await timed(calls, open_dh))
+
+    async def search(i):
+        return await service.call_search_items({"group": str(i % GROUPS)})
+
+    results["SearchItems"] = summarize(await timed(calls, search))
+
+    dummy, session_path = await service.call_open_session("plain", Variant("s", ""))
+    unlocked, locked = await service.call_search_items({})
+    random.seed(0)
+
+    async def get_secrets(i):
+        secrets = await service.call_get_secrets(random.sample(unlocked, min(batch, len(unlocked))), session_path)
+        assert all(secret[2] == b"password" for secret in secrets.values())
+
+    latencies = await timed(calls, get_secrets)
+    results["GetSecrets"] = summarize(latencies, count=len(latencies) * min(batch, len(unlocked)))
+    results["GetSecrets"]["batch"] = min(batch, len(unlocked))
+
+    async def create_item(i):
+        properties = {ITEM_LABEL: Variant("s", "new{}".format(i)), ITEM_ATTRIBUTES: Variant("a{ss}", {"group": "new"})}
+        await collection.call_create_item(properties, [session_path, b"", b"password", "text/plain"], False)
+
+    results["CreateItem"] = summarize(await timed(calls, create_item))
+
+    extension = await env.get_interface(base_path + "/aliases/default", collection_interface)
+
+    async def create_items(i):
+        entries = []
+        for j in range(batch):
+            properties = {ITEM_LABEL: Variant("s", "bulk{}".format(j)), ITEM_ATTRIBUTES: Variant("a{ss}", {"group": "bulk", "bulk": str(i)})}
+            entries.append([properties, [session_path, b"", b"password", "text/plain"]])
+        await extension.call_create_items(entries, False)
+
+    latencies = await timed(max(calls // batch, 1), create_items)
+    results["CreateItems"] = summarize(latencies, count=len(latencies) * batch)
+    results["CreateItems"]["batch"] = batch
+    return results
+
+
+async def bench_size(items, calls, batch, options):
+    path = tempfile.mkdtemp(prefix="pss-bench-")
+    try:
+        start = time.perf_counter()
+        build_store(path, items)
+        build = time.perf_counter() - start
+        # The first start builds the manifest, the second one can use it
+        startups = []
+        for run in range(2):
+            async with ServiceProcess(path, options) as env:
+                startups.append(env.startup)
+        async with ServiceProcess(path, options) as env:
+            results = await bench_methods(env, calls, batch)
+        results["startup"] = {"cold_s": round(startups[0], 3), "warm_s": round(startups[1], 3)}
+        results["build_store_s"] = round(build, 3)
+    finally:
+        shutil.rmtree(path)
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout.decode().strip()
+    except Exception:
+        return None
+
+
+@click.command()
+@click.option("--sizes", help="comma separated numbers of items in the synthetic stores", default="1000,10000,100000", show_default=True)
+@click.option("--calls", help="number of calls per method", type=int, default=100, show_default=True)
+@click.option("--batch", help="number of items per GetSecrets call", type=int, default=10, show_default=True)
+@click.option("--output", help="write the JSON results to this file instead of stdout", type=click.File("w"), default="-")
+@click.argument("service_options", nargs=-1)
+def main(sizes, calls, batch, output, service_options):
+    # Arguments after -- are passed on to the service, e.g. -- --gpg-workers 8
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "calls": calls,
+        "sizes": {},
+    }
+    for items in [int(size) for size in sizes.split(",")]:
+        click.echo("Benchmarking {} items".format(items), err=True)
+        report["sizes"][str(items)] = asyncio.run(bench_size(items, calls, batch, list(service_options)))
+    json.dump(report, output, indent=2, sort_keys=True)
+    output.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+
+class SecretCache:
+    # Size bounded LRU cache of decrypted passwords with a time to live.
+    # Passwords are kept in bytearrays, which are zeroed when they leave the cache.
+
+    def __init__(self, ttl, max_entries=128):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # Bumped on every eviction, so decryptions racing with an eviction are not cached
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._timer = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _wipe(entry):
+        expires, buffer = entry
+        buffer[:] = bytes(len(buffer))
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry[0] <= time.monotonic():
+            self._wipe(self._entries.pop(key))
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry[1].decode("utf8")
+
+    def put(self, key, password, generation):
+        if generation != self.generation or password is None:
+            return
+        old_entry = self._entries.pop(key, None)
+        if old_entry is not None:
+            self._wipe(old_entry)
+        self._entries[key] = (time.monotonic() + self.ttl, bytearray(password.encode("utf8")))
+        while len(self._entries) > self.max_entries:
+            self._wipe(self._entries.popitem(last=False)[1])
+        self._schedule_purge()
+
+    def evict(self, key):
+        self.generation += 1
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._wipe(entry)
+
+    def evict_collection(self, collection_id):
+        self.generation += 1
+        for key in [key for key in self._entries if key[0] == collection_id]:
+            self._wipe(self._entries.pop(key))
+
+    def clear(self):
+        self.generation += 1
+        while self._entries:
+            self._wipe(self._entries.popitem()[1])
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _schedule_purge(self):
+        if self._timer is None and self._entries:
+            expires = min(entry[0] for entry in self._entries.values())
+            self._timer = asyncio.get_running_loop().call_later(max(expires - time.monotonic(), 0), self._purge)
+
+    def _purge(self):
+        self._timer = None
+        now = time.monotonic()
+        for key in [key for key, entry in self._entries.items() if entry[0] <= now]:
+            self._wipe(self._entries.pop(key))
+        self._schedule_purge()
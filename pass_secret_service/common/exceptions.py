@@ -1,6 +1,11 @@
 from dbus_next import DBusError
 
 
+class DBusErrorFailed(DBusError):
+    def __init__(self, message):
+        super().__init__("org.freedesktop.DBus.Error.Failed", message)
+
+
 class DBusErrorNotSupported(DBusError):
     def __init__(self):
         super().__init__("org.freedesktop.DBus.Error.NotSupported", "This is not supported.")
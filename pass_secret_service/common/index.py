@@ -0,0 +1,41 @@
+class AttributeIndex:
+    # Inverted index from (attribute, value) pairs to the objects carrying them.
+    # Postings are dicts used as insertion ordered sets, so results keep a stable order.
+
+    def __init__(self):
+        self._postings = {}
+        self._attributes = {}
+
+    def __len__(self):
+        return len(self._attributes)
+
+    def add(self, obj, attributes):
+        self.remove(obj)
+        # Kept by reference to save a copy per object, callers replace attributes instead of changing them in place
+        self._attributes[obj] = attributes
+        for pair in attributes.items():
+            self._postings.setdefault(pair, {})[obj] = None
+
+    def remove(self, obj):
+        attributes = self._attributes.pop(obj, None)
+        if attributes is None:
+            return
+        for pair in attributes.items():
+            posting = self._postings[pair]
+            del posting[obj]
+            if not posting:
+                del self._postings[pair]
+
+    def search(self, attributes):
+        if not attributes:
+            return list(self._attributes)
+        postings = []
+        for pair in attributes.items():
+            posting = self._postings.get(pair)
+            if not posting:
+                return []
+            postings.append(posting)
+        # Intersect starting with the smallest posting list
+        postings.sort(key=len)
+        smallest, others = postings[0], postings[1:]
+        return [obj for obj in smallest if all(obj in posting for posting in others)]
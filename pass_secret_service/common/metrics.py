@@ -0,0 +1,102 @@
+import asyncio
+import bisect
+import contextlib
+import functools
+import threading
+import time
+
+from pass_secret_service.common import trace
+from pass_secret_service.common.tools import current_message
+
+
+# Upper bounds of the latency buckets in seconds, the last bucket is unbounded
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Histogram:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def observe(self, seconds, error=False):
+        self.count += 1
+        self.errors += error
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+
+    def stats(self):
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "sum_s": self.total,
+            "max_s": self.max,
+            # [upper bound, count] pairs, null stands for infinity
+            "buckets": [[bound, count] for bound, count in zip(BUCKETS + (None,), self.buckets) if count],
+        }
+
+
+class Metrics:
+    # Latency histograms by name, safe to update from executor threads
+    def __init__(self):
+        self.started = time.monotonic()
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, seconds, error=False):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds, error)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        error = True
+        try:
+            yield
+            error = False
+        finally:
+            self.observe(name, time.perf_counter() - start, error)
+
+    def snapshot(self):
+        with self._lock:
+            return {name: histogram.stats() for name, histogram in sorted(self.histograms.items())}
+
+
+metrics = Metrics()
+
+
+def _timed(fn, name):
+    if asyncio.iscoroutinefunction(fn):
+
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with metrics.timer(name), trace.span(name, current_message.get()):
+                return await fn(*args, **kwargs)
+
+    else:
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with metrics.timer(name), trace.span(name, current_message.get()):
+                return fn(*args, **kwargs)
+
+    return wrapper
+
+
+def timed_methods(interface_name):
+    # Class decorator recording the latency of every D-Bus method of the interface as "<interface_name>.<method>",
+    # and a span per call when tracing is on
+    def decorator(cls):
+        for member in vars(cls).values():
+            dbus_method = getattr(member, "__dict__", {}).get("__DBUS_METHOD")
+            if dbus_method is not None:
+                dbus_method.fn = _timed(dbus_method.fn, "{}.{}".format(interface_name, dbus_method.name))
+        return cls
+
+    return decorator
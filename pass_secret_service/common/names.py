@@ -4,5 +4,13 @@ bus_name = "org.freedesktop.secrets"
 base_path = "/org/freedesktop/secrets"
 
 COLLECTION_LABEL = "org.freedesktop.Secret.Collection.Label"
+COLLECTION_CREATED = "org.freedesktop.Secret.Collection.Created"
+COLLECTION_MODIFIED = "org.freedesktop.Secret.Collection.Modified"
 ITEM_LABEL = "org.freedesktop.Secret.Item.Label"
 ITEM_ATTRIBUTES = "org.freedesktop.Secret.Item.Attributes"
+ITEM_CREATED = "org.freedesktop.Secret.Item.Created"
+ITEM_MODIFIED = "org.freedesktop.Secret.Item.Modified"
+
+metrics_interface = "io.github.mdellweg.PassSecretService.Metrics"
+collection_interface = "io.github.mdellweg.PassSecretService.Collection"
+store_interface = "io.github.mdellweg.PassSecretService.Store"
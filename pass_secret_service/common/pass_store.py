@@ -1,40 +1,313 @@
 import os
 import shutil
+import subprocess
+import tempfile
+import threading
+import time
 import uuid
 import json
+import logging
+from copy import deepcopy
 from pypass import PasswordStore
+from pypass.passwordstore import GPG_BIN
 
+from pass_secret_service.common.metrics import metrics
+from pass_secret_service.common.names import COLLECTION_CREATED, COLLECTION_MODIFIED, ITEM_CREATED, ITEM_MODIFIED
+
+
+logger = logging.getLogger(__name__)
 
 # Work around a typo in pypass
 if not hasattr(PasswordStore, "get_decrypted_password"):
     PasswordStore.get_decrypted_password = PasswordStore.get_decypted_password
 
 
+class PypassDecryptor:
+    # Forks gpg through pypass for every call
+    def __init__(self, store):
+        self._store = store
+
+    def decrypt(self, passfile_path):
+        return self._store.get_decrypted_password(os.path.relpath(passfile_path[: -len(".gpg")], self._store.path))
+
+
+class GpgDecryptor:
+    # Drives gpg directly. Callers run it on the "gpg" executor, whose size bounds the number of concurrent gpg processes.
+    def decrypt(self, passfile_path):
+        gpg = subprocess.run(
+            [GPG_BIN, "--quiet", "--batch", "--use-agent", "--no-tty", "--decrypt", os.path.realpath(passfile_path)],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+        )
+        if gpg.returncode == 0:
+            return gpg.stdout.decode()
+
+
 class PassStore:
     PREFIX = "secret_service"
+    MANIFEST = ".manifest"
+    MANIFEST_VERSION = 2
+    GPG_ID = ".gpg-id"
+    # Marks collections keeping their items in subdirectories named after the first characters of the item names,
+    # and collections whose migration to that layout is underway
+    SHARDED = ".sharded"
+    SHARDING = ".sharding"
+    SHARD_PREFIX = 2
+    # Collections are renamed to this prefix before they are removed, so a crash never leaves half of one behind
+    DELETING = ".deleting-"
+    # Timestamps this close to now may still change within the same filesystem tick
+    RACY_WINDOW_NS = 2 * 10**9
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, pypass_decrypt=False, shard=False, **kwargs):
         self._store = PasswordStore(*args, **kwargs)
+        if pypass_decrypt:
+            self.decryptor = PypassDecryptor(self._store)
+        else:
+            self.decryptor = GpgDecryptor()
         self.base_path = os.path.join(self._store.path, self.PREFIX)
         if not os.path.exists(self.base_path):
             os.makedirs(self.base_path)
+        self._manifest = self._load_manifest()
+        # Collections whose manifest entry was dropped from memory, it stays on disk until they are loaded again
+        self._evicted = set()
+        # Collections are loaded and evicted from several threads. The first lock guards _manifest and _evicted
+        # and does no I/O, the second one keeps manifest writes in order.
+        self._manifest_lock = threading.Lock()
+        self._manifest_write_lock = threading.Lock()
+        # Migrate flat collections to the sharded layout when they are loaded
+        self.shard = shard
+        self._sharded = {}
+        # Write-behind buffer of json files, see queue_* and flush
+        self._pending = {}
+        # Guards the dict only, no I/O happens under it
+        self._pending_lock = threading.Lock()
+        # Held while a queued file is written, so discarding it waits for the write instead of being undone by it
+        self._flush_lock = threading.Lock()
+        # Serialize writes of the same .gpg file, striped by path
+        self._gpg_locks = [threading.Lock() for i in range(64)]
+        # Files written or removed by this process, with their state afterwards, see track_writes
+        self._own_writes = None
+
+    # Files
+    def _read_json(self, path):
+        with self._pending_lock:
+            if path in self._pending:
+                return deepcopy(self._pending[path])
+        # Entries stay queued until their file is written, so the file is at least as new as the queue was
+        try:
+            with open(path, "r") as fp:
+                data = json.load(fp)
+        except Exception:
+            data = {}
+        return data or {}
+
+    def _write_json(self, path, data):
+        self._write_file(path, json.dumps(data, sort_keys=True))
+
+    def _write_file(self, path, text):
+        # Write atomically, so readers never see a partial file; concurrent writers each get a temporary file of their own
+        directory, name = os.path.split(path)
+        fd, tmp_path = tempfile.mkstemp(prefix="." + name + ".", suffix=".tmp", dir=directory)
+        try:
+            with os.fdopen(fd, "w") as fp:
+                fp.write(text)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self._record_write(path)
+
+    def _write_json_batch(self, entries):
+        # _write_json for many files, then every directory holding them is synced once, so the renames are durable too
+        directories = set()
+        for path, data in entries:
+            self._write_json(path, data)
+            directories.add(os.path.dirname(path))
+        for directory in directories:
+            fd = os.open(directory, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    @staticmethod
+    def _mtimes(*paths):
+        mtimes = []
+        for path in paths:
+            try:
+                mtimes.append(int(os.stat(path).st_mtime))
+            except FileNotFoundError:
+                pass
+        return mtimes
+
+    @staticmethod
+    def _file_state(path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def track_writes(self):
+        # Lets a watcher of the store tell its own changes from those of others, see changed_by_others
+        self._own_writes = {}
+
+    def _record_write(self, path):
+        if self._own_writes is not None:
+            self._own_writes[path] = self._file_state(path)
+
+    def changed_by_others(self, collection_name, names):
+        # Drops the files still in the state this process left them in, and temporary files; every recorded write is matched once
+        changed = set()
+        for name in names:
+            if name == ".properties":
+                path = os.path.join(self.base_path, collection_name, name)
+            elif name.startswith("."):
+                # Temporary files and markers
+                continue
+            else:
+                path = os.path.join(os.path.dirname(self._item_path(collection_name, name)), name)
+            if self._own_writes is None or self._own_writes.pop(path, False) != self._file_state(path):
+                changed.add(name)
+        return changed
+
+    def _gpg_lock(self, path):
+        return self._gpg_locks[hash(path) % len(self._gpg_locks)]
+
+    def _encrypt(self, path, password, recipients, replace_only=False):
+        # Encrypt to a temporary file and rename it into place, so readers never see a partial file.
+        # With replace_only, a file deleted meanwhile is not brought back and False is returned.
+        directory, name = os.path.split(path)
+        tmp_path = os.path.join(directory, "." + name + ".tmp")
+        recipient_args = [arg for recipient in recipients for arg in ("--recipient", recipient)]
+        with metrics.timer("gpg.encrypt"):
+            try:
+                subprocess.run(
+                    [GPG_BIN, "--encrypt", *recipient_args, "--batch", "--use-agent", "--no-tty", "--yes", "--output", tmp_path],
+                    input=password.encode(),
+                    stdout=subprocess.DEVNULL,
+                    check=True,
+                )
+                with open(tmp_path, "rb") as fp:
+                    os.fsync(fp.fileno())
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+        if replace_only and not os.path.exists(path):
+            os.remove(tmp_path)
+            return False
+        os.replace(tmp_path, path)
+        self._record_write(path)
+        return True
+
+    def _queue_json(self, path, data):
+        # Does no I/O, the file is written on the next flush; later calls for the same file supersede earlier ones
+        data = deepcopy(data)
+        with self._pending_lock:
+            self._pending[path] = data
+
+    def _discard_pending(self, path_prefix):
+        with self._flush_lock, self._pending_lock:
+            for path in [path for path in self._pending if path.startswith(path_prefix)]:
+                del self._pending[path]
+
+    def flush(self):
+        # Files that fail to write stay queued for the next flush, the first error is raised once the others are written
+        error = None
+        with self._pending_lock:
+            paths = list(self._pending)
+        for path in paths:
+            with self._flush_lock:
+                with self._pending_lock:
+                    data = self._pending.get(path)
+                if data is None:
+                    continue
+                try:
+                    self._write_json(path, data)
+                except OSError as e:
+                    error = error or e
+                    continue
+                with self._pending_lock:
+                    # Unless it was queued again meanwhile
+                    if self._pending.get(path) is data:
+                        del self._pending[path]
+        if error is not None:
+            raise error
+
+    # Manifest
+    def _load_manifest(self):
+        try:
+            with open(os.path.join(self.base_path, self.MANIFEST), "r") as fp:
+                manifest = json.load(fp)
+            if manifest["version"] != self.MANIFEST_VERSION:
+                raise ValueError("Unsupported manifest version")
+            collections = manifest["collections"]
+        except Exception:
+            collections = {}
+        return collections
+
+    def save_manifest(self):
+        with self._manifest_write_lock:
+            existing = set(self.get_collections())
+            on_disk = self._load_manifest() if self._evicted else {}
+            with self._manifest_lock:
+                # Entries of collections removed behind our back are dropped
+                for name in [name for name in self._manifest if name not in existing]:
+                    del self._manifest[name]
+                self._evicted &= existing
+                collections = {**{name: on_disk[name] for name in self._evicted if name in on_disk}, **self._manifest}
+                text = json.dumps({"version": self.MANIFEST_VERSION, "collections": collections}, sort_keys=True)
+            self._write_file(os.path.join(self.base_path, self.MANIFEST), text)
+
+    def evict_collection(self, name):
+        # Drops the cached metadata of a collection from memory, get_items_properties reads it back from the manifest on disk.
+        # The entry is brought up to date first, so unlocking reads as little as possible.
+        self.get_items_properties(name)
+        self.save_manifest()
+        with self._manifest_lock:
+            if self._manifest.pop(name, None) is not None:
+                self._evicted.add(name)
+
+    def _stable_mtime(self, path):
+        # Returns None for missing files and for racily recent timestamps, so they are never trusted
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        if mtime > time.time_ns() - self.RACY_WINDOW_NS:
+            return None
+        return mtime
 
     # Aliases
     def get_aliases(self):
-        try:
-            with open(os.path.join(self.base_path, ".aliases"), "r") as fp:
-                aliases = json.load(fp)
-        except Exception:  # pragma: no cover
-            aliases = {}
-        return aliases or {}
+        return self._read_json(os.path.join(self.base_path, ".aliases"))
 
     def save_aliases(self, aliases):
-        with open(os.path.join(self.base_path, ".aliases"), "w") as fp:
-            json.dump(aliases, fp, sort_keys=True)
+        self._write_json(os.path.join(self.base_path, ".aliases"), aliases)
+
+    def queue_aliases(self, aliases):
+        self._queue_json(os.path.join(self.base_path, ".aliases"), aliases)
+
+    # Recipients
+    def get_recipients(self, collection_name):
+        # Like pass, the .gpg-id file closest to the collection applies
+        directory = os.path.join(self.base_path, collection_name)
+        while True:
+            try:
+                with open(os.path.join(directory, self.GPG_ID), "r") as fp:
+                    return [line.strip() for line in fp if line.strip() and not line.startswith("#")]
+            except FileNotFoundError:
+                if os.path.samefile(directory, self._store.path):
+                    raise
+                directory = os.path.dirname(directory)
 
     # Collections (Directories)
     def get_collections(self):
-        return (entry.name for entry in os.scandir(self.base_path) if entry.is_dir())
+        return (entry.name for entry in os.scandir(self.base_path) if entry.is_dir() and not entry.name.startswith("."))
 
     def create_collection(self, properties):
         while True:
@@ -43,69 +316,249 @@ class PassStore:
             if not os.path.exists(collection_path):  # check for clashes  # pragma: no branch
                 break
         os.mkdir(collection_path)
+        if self.shard:
+            open(os.path.join(collection_path, self.SHARDED), "w").close()
         self.save_collection_properties(name, properties)
         return name
 
+    # Layout
+    def is_sharded(self, collection_name):
+        sharded = self._sharded.get(collection_name)
+        if sharded is None:
+            sharded = self._sharded[collection_name] = os.path.exists(os.path.join(self.base_path, collection_name, self.SHARDED))
+        return sharded
+
+    def _item_path(self, collection_name, name):
+        # Path of an item without the suffix
+        if self.is_sharded(collection_name):
+            return os.path.join(self.base_path, collection_name, name[: self.SHARD_PREFIX], name)
+        return os.path.join(self.base_path, collection_name, name)
+
+    def _item_directories(self, collection_name):
+        collection_path = os.path.join(self.base_path, collection_name)
+        if not self.is_sharded(collection_name):
+            return {"": collection_path}
+        return {entry.name: entry.path for entry in os.scandir(collection_path) if entry.is_dir() and not entry.name.startswith(".")}
+
+    def shard_collection(self, collection_name):
+        # Moves the items of a flat collection into shards. Resumes where an interrupted migration stopped,
+        # the layout only switches once all files are in place.
+        collection_path = os.path.join(self.base_path, collection_name)
+        sharding_path = os.path.join(collection_path, self.SHARDING)
+        open(sharding_path, "a").close()
+        for entry in os.scandir(collection_path):
+            if entry.is_file() and not entry.name.startswith(".") and entry.name.endswith((".gpg", ".properties")):
+                shard_path = os.path.join(collection_path, entry.name[: self.SHARD_PREFIX])
+                os.makedirs(shard_path, exist_ok=True)
+                os.rename(entry.path, os.path.join(shard_path, entry.name))
+        os.rename(sharding_path, os.path.join(collection_path, self.SHARDED))
+        self._sharded[collection_name] = True
+        with self._manifest_lock:
+            self._manifest.pop(collection_name, None)
+
     def delete_collection(self, name):
-        shutil.rmtree(os.path.join(self.base_path, name))
+        self.trash_collection(name)
+        self.purge_collections()
+
+    def trash_collection(self, name):
+        # The collection is gone as soon as this returns; its files are removed by purge_collections
+        self._discard_pending(os.path.join(self.base_path, name, ""))
+        os.rename(os.path.join(self.base_path, name), os.path.join(self.base_path, self.DELETING + name))
+        with self._manifest_lock:
+            self._manifest.pop(name, None)
+            self._evicted.discard(name)
+        self._sharded.pop(name, None)
+
+    def purge_collections(self):
+        # Removes trashed collections, including those left over by a crash
+        for entry in os.scandir(self.base_path):
+            if entry.is_dir() and entry.name.startswith(self.DELETING):
+                shutil.rmtree(entry.path, ignore_errors=True)
 
     def save_collection_properties(self, name, properties):
-        with open(os.path.join(self.base_path, name, ".properties"), "w") as fp:
-            json.dump(properties, fp, sort_keys=True)
+        self._write_json(os.path.join(self.base_path, name, ".properties"), properties)
+
+    def queue_collection_properties(self, name, properties):
+        self._queue_json(os.path.join(self.base_path, name, ".properties"), properties)
 
     def get_collection_properties(self, name):
+        return self._read_json(os.path.join(self.base_path, name, ".properties"))
+
+    def backfill_collection_timestamps(self, name, properties):
+        # Collections created before timestamps were kept get them from the modification time of their metadata, once.
+        # Writing them back is best effort, e.g. on a read-only store they are derived again on every start.
+        properties_path = os.path.join(self.base_path, name, ".properties")
+        mtimes = self._mtimes(properties_path)
+        if COLLECTION_CREATED in properties or not mtimes:
+            return properties
+        properties = {**properties, COLLECTION_CREATED: mtimes[0], COLLECTION_MODIFIED: mtimes[0]}
         try:
-            with open(os.path.join(self.base_path, name, ".properties"), "r") as fp:
-                properties = json.load(fp)
-        except Exception:  # pragma: no cover
-            properties = {}
-        return properties or {}
-
-    def update_collection_properties(self, name, new_properties):
-        properties = self.get_collection_properties(name)
-        properties.update(new_properties)
-        self.save_collection_properties(name, properties)
+            self._write_json(properties_path, properties)
+        except OSError:
+            logger.warning("Failed to save the timestamps of collection %s", name, exc_info=True)
         return properties
 
     # Items
+    @staticmethod
+    def _scan_items(path):
+        return [entry.name[:-4] for entry in os.scandir(path) if entry.is_file() and entry.name.endswith(".gpg")]
+
     def get_items(self, collection_name):
+        return (name for path in self._item_directories(collection_name).values() for name in self._scan_items(path))
+
+    def get_items_properties(self, collection_name):
+        # Bulk load of all item properties, validated against the manifest; only changed directories are listed again
         collection_path = os.path.join(self.base_path, collection_name)
-        return (entry.name[:-4] for entry in os.scandir(collection_path) if entry.is_file() and entry.name.endswith(".gpg"))
+        if os.path.exists(os.path.join(collection_path, self.SHARDING)) or (self.shard and not self.is_sharded(collection_name)):
+            self.shard_collection(collection_name)
+        if collection_name in self._evicted:
+            on_disk = self._load_manifest().get(collection_name, {})
+            with self._manifest_lock:
+                if collection_name in self._evicted:
+                    self._evicted.discard(collection_name)
+                    self._manifest[collection_name] = on_disk
+        with self._manifest_lock:
+            cached_directories = self._manifest.get(collection_name, {})
+        directories = {}
+        for directory, path in self._item_directories(collection_name).items():
+            cached = cached_directories.get(directory, {})
+            cached_items = cached.get("items", {})
+            mtime = self._stable_mtime(path)
+            if mtime is not None and cached.get("mtime") == mtime:
+                names = list(cached_items)
+            else:
+                names = self._scan_items(path)
+            items = {}
+            for name in names:
+                properties_path = os.path.join(path, name) + ".properties"
+                item_mtime = self._stable_mtime(properties_path)
+                cached_item = cached_items.get(name)
+                if item_mtime is not None and cached_item and cached_item["mtime"] == item_mtime and properties_path not in self._pending:
+                    properties = cached_item["properties"]
+                else:
+                    properties = self.get_item_properties(collection_name, name)
+                items[name] = {"mtime": item_mtime, "properties": properties}
+            directories[directory] = {"mtime": mtime, "items": items}
+        with self._manifest_lock:
+            self._manifest[collection_name] = directories
+        return {name: item["properties"] for directory in directories.values() for name, item in directory["items"].items()}
 
-    def create_item(self, collection_name, password, properties):
+    def backfill_item_timestamps(self, collection_name, items_properties):
+        # Items created before timestamps were kept get them from the modification times of their files.
+        # They are written back in one batch, so this happens once per item; like for collections, at best effort.
+        backfilled = {}
+        for name, properties in items_properties.items():
+            if ITEM_CREATED in properties:
+                continue
+            item_path = self._item_path(collection_name, name)
+            mtimes = self._mtimes(item_path + ".gpg", item_path + ".properties")
+            if mtimes:
+                backfilled[name] = {**properties, ITEM_CREATED: min(mtimes), ITEM_MODIFIED: max(mtimes)}
+        try:
+            self._write_json_batch([(self._item_path(collection_name, name) + ".properties", properties) for name, properties in backfilled.items()])
+            # Record the rewritten files in the manifest, so they are not read again on the next start
+            mtimes = {name: os.stat(self._item_path(collection_name, name) + ".properties").st_mtime_ns for name in backfilled}
+        except OSError:
+            logger.warning("Failed to save the timestamps of %d items of collection %s", len(backfilled), collection_name, exc_info=True)
+            return {**items_properties, **backfilled}
+        with self._manifest_lock:
+            directories = self._manifest.get(collection_name, {})
+            for name, properties in backfilled.items():
+                directory = name[: self.SHARD_PREFIX] if self.is_sharded(collection_name) else ""
+                items = directories.get(directory, {}).get("items", {})
+                if name in items:
+                    items[name] = {"mtime": mtimes[name], "properties": properties}
+        return {**items_properties, **backfilled}
+
+    def get_changed_items_properties(self, collection_name, names):
+        # Properties of the items with the given names, None for those that are gone; the manifest is left alone
+        items_properties = {}
+        gone = {}
+        for name in names:
+            if os.path.exists(self._item_path(collection_name, name) + ".gpg"):
+                items_properties[name] = self.get_item_properties(collection_name, name)
+            else:
+                gone[name] = None
+        return {**self.backfill_item_timestamps(collection_name, items_properties), **gone}
+
+    def _new_item_name(self, collection_name):
         while True:
             name = str(uuid.uuid4()).replace("-", "_")
-            item_path = os.path.join(self.base_path, collection_name, name)
-            if not os.path.exists(item_path):  # check for clashes  # pragma: no branch
-                break
+            item_path = self._item_path(collection_name, name)
+            if not os.path.exists(item_path + ".gpg"):  # check for clashes  # pragma: no branch
+                os.makedirs(os.path.dirname(item_path), exist_ok=True)
+                return name
+
+    def create_item(self, collection_name, password, properties):
+        name = self._new_item_name(collection_name)
         self.set_item_password(collection_name, name, password)
         self.save_item_properties(collection_name, name, properties)
         return name
 
+    def prepare_items(self, collection_name, properties_list):
+        # Writes the metadata of many new items in one go and returns their names; the items appear once their password is set
+        names = [self._new_item_name(collection_name) for properties in properties_list]
+        self._write_json_batch([(self._item_path(collection_name, name) + ".properties", properties) for name, properties in zip(names, properties_list)])
+        return names
+
+    def discard_items(self, collection_name, names):
+        # Removes whatever exists of the given items
+        for name in names:
+            item_path = self._item_path(collection_name, name)
+            # Under the gpg lock, so a running re-encryption cannot bring the file back
+            with self._gpg_lock(item_path + ".gpg"):
+                for suffix in (".gpg", ".properties"):
+                    try:
+                        os.remove(item_path + suffix)
+                    except FileNotFoundError:
+                        pass
+                    self._record_write(item_path + suffix)
+
     def delete_item(self, collection_name, name):
-        os.remove(os.path.join(self.base_path, collection_name, name) + ".gpg")
-        os.remove(os.path.join(self.base_path, collection_name, name) + ".properties")
+        item_path = self._item_path(collection_name, name)
+        self._discard_pending(item_path + ".properties")
+        with self._gpg_lock(item_path + ".gpg"):
+            os.remove(item_path + ".gpg")
+            os.remove(item_path + ".properties")
+        self._record_write(item_path + ".gpg")
+        self._record_write(item_path + ".properties")
 
     def set_item_password(self, collection_name, name, password):
-        self._store.insert_password(os.path.join(self.PREFIX, collection_name, name), password)
+        path = self._item_path(collection_name, name) + ".gpg"
+        with self._gpg_lock(path):
+            self._encrypt(path, password, self.get_recipients(collection_name))
+
+    def reencrypt_item(self, collection_name, name, recipients):
+        # Returns False if the item was written concurrently, and so is already encrypted for the current recipients,
+        # or if it was deleted
+        path = self._item_path(collection_name, name) + ".gpg"
+        try:
+            before = os.stat(path)
+        except FileNotFoundError:
+            return False
+        password = self.get_item_password(collection_name, name)
+        if password is None:
+            if not os.path.exists(path):
+                return False
+            raise ValueError("Failed to decrypt {}".format(path))
+        with self._gpg_lock(path):
+            try:
+                after = os.stat(path)
+            except FileNotFoundError:
+                return False
+            if (after.st_ino, after.st_mtime_ns, after.st_size) != (before.st_ino, before.st_mtime_ns, before.st_size):
+                return False
+            return self._encrypt(path, password, recipients, replace_only=True)
 
     def get_item_password(self, collection_name, name):
-        return self._store.get_decrypted_password(os.path.join(self.PREFIX, collection_name, name))
+        with metrics.timer("gpg.decrypt"):
+            return self.decryptor.decrypt(self._item_path(collection_name, name) + ".gpg")
 
     def save_item_properties(self, collection_name, name, properties):
-        with open(os.path.join(self.base_path, collection_name, name) + ".properties", "w") as fp:
-            json.dump(properties, fp, sort_keys=True)
+        self._write_json(self._item_path(collection_name, name) + ".properties", properties)
+
+    def queue_item_properties(self, collection_name, name, properties):
+        self._queue_json(self._item_path(collection_name, name) + ".properties", properties)
 
     def get_item_properties(self, collection_name, name):
-        try:
-            with open(os.path.join(self.base_path, collection_name, name) + ".properties", "r") as fp:
-                properties = json.load(fp)
-        except Exception:  # pragma: no cover
-            properties = {}
-        return properties or {}
-
-    def update_item_properties(self, collection_name, name, new_properties):
-        properties = self.get_item_properties(collection_name, name)
-        properties.update(new_properties)
-        self.save_item_properties(collection_name, name, properties)
-        return properties
+        return self._read_json(self._item_path(collection_name, name) + ".properties")
@@ -0,0 +1,57 @@
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class SamplingProfiler:
+    # Samples the stacks of all threads at a fixed interval, without slowing down the sampled code in between.
+    # The result is written in collapsed stack format ("folded"), which flamegraph.pl and speedscope read.
+    def __init__(self, directory, interval=0.005, duration=30.0):
+        self.directory = directory
+        self.interval = interval
+        self.duration = duration
+        self._thread = None
+        self._stop = threading.Event()
+
+    def trigger(self):
+        # Starts a profile, or ends the running one early
+        if self._thread is not None and self._thread.is_alive():
+            self._stop.set()
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def _stack(frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+            frame = frame.f_back
+        return ";".join(reversed(stack))
+
+    def _run(self):
+        path = os.path.join(self.directory, "profile-{}-{}.folded".format(os.getpid(), time.strftime("%Y%m%d-%H%M%S")))
+        logger.info("Profiling to %s", path)
+        own_id = threading.get_ident()
+        names = {}
+        samples = collections.Counter()
+        end = time.monotonic() + self.duration
+        while not self._stop.wait(self.interval) and time.monotonic() < end:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                if thread_id not in names:
+                    names = {thread.ident: thread.name for thread in threading.enumerate()}
+                samples[names.get(thread_id, str(thread_id)) + ";" + self._stack(frame)] += 1
+        with open(path, "w") as fp:
+            for stack, count in samples.most_common():
+                fp.write("{} {}\n".format(stack, count))
+        logger.info("Wrote profile with %d samples to %s", sum(samples.values()), path)
@@ -0,0 +1,124 @@
+import asyncio
+import json
+import logging
+import os
+import time
+
+from pass_secret_service.common.tools import gather_bounded, MeteredExecutor
+
+
+logger = logging.getLogger(__name__)
+
+JOURNAL = ".reencrypt.journal"
+# Log the progress every this many items
+PROGRESS_INTERVAL = 100
+
+
+class Journal:
+    # Append-only list of the items re-encrypted so far, with the recipients they were encrypted for, so an interrupted run can resume.
+    # Lines are not synced; after a crash a few items may be re-encrypted twice, which does no harm.
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        self._fp = None
+        try:
+            with open(path, "r") as fp:
+                for line in fp:
+                    try:
+                        collection_name, name, recipients = json.loads(line)
+                    except ValueError:
+                        # Torn last line
+                        continue
+                    self.done.add((collection_name, name, tuple(recipients)))
+        except FileNotFoundError:
+            pass
+
+    def __contains__(self, entry):
+        return entry in self.done
+
+    def add(self, entry):
+        if self._fp is None:
+            self._fp = open(self.path, "a")
+        collection_name, name, recipients = entry
+        self._fp.write(json.dumps([collection_name, name, list(recipients)]) + "\n")
+        self._fp.flush()
+        self.done.add(entry)
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+    def remove(self):
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class Reencryption:
+    # Re-encrypts the items of some or all collections for the recipients currently in their .gpg-id,
+    # on an executor of its own, so the gpg executor stays free for serving secrets
+    def __init__(self, pass_store, collections=None, workers=4):
+        self.pass_store = pass_store
+        self.collections = collections
+        self.workers = workers
+        self.total = 0
+        self.reencrypted = 0
+        self.skipped = 0
+        self.failed = []
+
+    def progress(self):
+        return {"total": self.total, "reencrypted": self.reencrypted, "skipped": self.skipped, "failed": len(self.failed)}
+
+    def _plan(self, journal):
+        collections = self.collections or list(self.pass_store.get_collections())
+        jobs = []
+        for collection_name in collections:
+            recipients = tuple(self.pass_store.get_recipients(collection_name))
+            for name in self.pass_store.get_items(collection_name):
+                entry = (collection_name, name, recipients)
+                if entry in journal:
+                    self.skipped += 1
+                else:
+                    jobs.append(entry)
+        return jobs
+
+    async def _reencrypt_item(self, executor, journal, entry, start):
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(executor, self.pass_store.reencrypt_item, *entry)
+        except Exception:
+            logger.warning("Failed to re-encrypt %s/%s", entry[0], entry[1], exc_info=True)
+            self.failed.append("{}/{}".format(entry[0], entry[1]))
+            return
+        journal.add(entry)
+        self.reencrypted += 1
+        if self.reencrypted % PROGRESS_INTERVAL == 0:
+            elapsed = time.perf_counter() - start
+            logger.info("Re-encrypted %d of %d items, %.1f items/s", self.reencrypted, self.total, self.reencrypted / elapsed)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        executor = MeteredExecutor("reencrypt", self.workers)
+        journal = Journal(os.path.join(self.pass_store.base_path, JOURNAL))
+        start = time.perf_counter()
+        try:
+            jobs = await loop.run_in_executor(executor, self._plan, journal)
+            self.total = len(jobs)
+            await gather_bounded(self.workers, (self._reencrypt_item(executor, journal, entry, start) for entry in jobs))
+        finally:
+            executor.shutdown(wait=False)
+            journal.close()
+        if not self.failed:
+            journal.remove()
+        elapsed = time.perf_counter() - start
+        return {
+            "reencrypted": self.reencrypted,
+            "skipped": self.skipped,
+            "failed": self.failed,
+            "seconds": elapsed,
+            "items_per_s": self.reencrypted / elapsed if elapsed else 0.0,
+            "workers": self.workers,
+        }
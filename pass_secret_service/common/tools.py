@@ -1,14 +1,260 @@
 import asyncio
+import contextlib
+import contextvars
+import functools
+import logging
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 
+from dbus_next import Message
+
+from pass_secret_service.common.trace import current_span
+
+
+logger = logging.getLogger(__name__)
+
+# The D-Bus message that is being processed; tasks dispatched for a message inherit it
+current_message = contextvars.ContextVar("current_message", default=None)
+
+# Number of signals emitted in a burst before waiting for the bus daemon to catch up
+SIGNAL_BATCH = 64
+
+
+class MeteredExecutor(ThreadPoolExecutor):
+    # Thread pool that keeps track of its queue depth and of how long jobs wait for a worker
+    def __init__(self, name, workers):
+        super().__init__(max_workers=workers, thread_name_prefix=name)
+        self.name = name
+        self.workers = workers
+        self.queued = 0
+        self.max_queued = 0
+        self.running = 0
+        self.completed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self._stats_lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        submitted = time.monotonic()
+        # Jobs run without the submitter's context, so the span is captured here
+        span = current_span.get()
+        with self._stats_lock:
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+
+        def job():
+            started = time.monotonic()
+            wait = started - submitted
+            with self._stats_lock:
+                self.queued -= 1
+                self.running += 1
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._stats_lock:
+                    self.running -= 1
+                    self.completed += 1
+                if span is not None:
+                    span.add(self.name, wait, time.monotonic() - started)
+
+        return super().submit(job)
+
+    def stats(self):
+        with self._stats_lock:
+            started = self.running + self.completed
+            return {
+                "workers": self.workers,
+                "queued": self.queued,
+                "max_queued": self.max_queued,
+                "running": self.running,
+                "completed": self.completed,
+                "wait_avg": self.wait_total / started if started else 0.0,
+                "wait_max": self.wait_max,
+            }
+
+
+# Separate pools, so a burst of slow gpg calls does not hold up metadata I/O or session setup:
+# "crypto" for DH and AES, "gpg" for gpg subprocesses, "fs" for reading and writing the store metadata
+executor_sizes = {"crypto": 2, "gpg": 4, "fs": 4}
+_executors = {}
+
+
+def configure_executors(**sizes):
+    # Takes effect for pools created after the call, so configure before the service starts
+    for name, size in sizes.items():
+        if name not in executor_sizes:
+            raise ValueError("Unknown executor {}".format(name))
+        executor_sizes[name] = size
+        executor = _executors.pop(name, None)
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+
+def get_executor(name):
+    executor = _executors.get(name)
+    if executor is None:
+        executor = _executors[name] = MeteredExecutor(name, executor_sizes[name])
+    return executor
+
+
+def executor_stats():
+    return {name: executor.stats() for name, executor in _executors.items()}
+
+
+def run_in_executor(f=None, pool="fs"):
+    # Use as @run_in_executor or @run_in_executor(pool="gpg")
+    if f is None:
+        return functools.partial(run_in_executor, pool=pool)
 
-def run_in_executor(f):
     async def wraps(*args, **kwargs):
         loop = asyncio.get_running_loop()
-        return await loop.run_in_executor(None, lambda: f(*args, **kwargs))
+        return await loop.run_in_executor(get_executor(pool), lambda: f(*args, **kwargs))
 
     return wraps
 
 
+async def gather_bounded(limit, aws):
+    # Like asyncio.gather, but with at most `limit` awaitables running at a time
+    semaphore = asyncio.Semaphore(limit)
+
+    async def bounded(aw):
+        async with semaphore:
+            return await aw
+
+    return await asyncio.gather(*(bounded(aw) for aw in aws))
+
+
+async def drain_bus(bus):
+    # The bus daemon answers in order, so the reply means it has read everything sent before.
+    # dbus_next drops the connection when a burst of messages overflows the socket buffer.
+    await bus.call(Message(destination="org.freedesktop.DBus", path="/org/freedesktop/DBus", interface="org.freedesktop.DBus.Peer", member="Ping"))
+
+
+async def emit_batched(bus, signal, objects):
+    for count, obj in enumerate(objects, 1):
+        signal(obj)
+        if count % SIGNAL_BATCH == 0:
+            await drain_bus(bus)
+
+
+class SingleFlight:
+    # Coalesces concurrent calls for the same key into one, all callers share its result
+    def __init__(self):
+        self.calls = 0
+        self.shared = 0
+        self._futures = {}
+
+    async def run(self, key, coro_function, *args):
+        future = self._futures.get(key)
+        if future is None:
+            self.calls += 1
+            future = asyncio.ensure_future(coro_function(*args))
+            self._futures[key] = future
+            future.add_done_callback(functools.partial(self._done, key))
+        else:
+            self.shared += 1
+        # Shielded, so a cancelled caller does not cancel the call for everybody else
+        return await asyncio.shield(future)
+
+    def _done(self, key, future):
+        if self._futures.get(key) is future:
+            del self._futures[key]
+
+    def forget(self, key):
+        # Later callers start a new call instead of joining the one in flight
+        self._futures.pop(key, None)
+
+
+class RWLock:
+    # Readers-writer lock for coroutines. Waiting writers hold off new readers, so a steady stream of reads cannot starve them.
+    def __init__(self):
+        self._condition = asyncio.Condition()
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+
+    @contextlib.asynccontextmanager
+    async def read(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: not self._writer and not self._writers_waiting)
+            self._readers += 1
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self._readers -= 1
+                if not self._readers:
+                    self._condition.notify_all()
+
+    @contextlib.asynccontextmanager
+    async def write(self):
+        async with self._condition:
+            self._writers_waiting += 1
+            try:
+                await self._condition.wait_for(lambda: not self._writer and not self._readers)
+            finally:
+                self._writers_waiting -= 1
+                # Readers held off by a cancelled writer may go ahead
+                self._condition.notify_all()
+            self._writer = True
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self._writer = False
+                self._condition.notify_all()
+
+
+class LockTable:
+    # Locks by key, created on demand and gone once nobody holds or waits for them
+    def __init__(self, factory=asyncio.Lock):
+        self._factory = factory
+        self._locks = weakref.WeakValueDictionary()
+
+    def __getitem__(self, key):
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = self._factory()
+        return lock
+
+    def __len__(self):
+        return len(self._locks)
+
+
+class WriteBehind:
+    # Runs the blocking `flush` in the fs executor once per burst of changes, `delay` seconds after the first one
+    def __init__(self, flush, delay=0.2):
+        self._flush = flush
+        self.delay = delay
+        self._timer = None
+        self._lock = asyncio.Lock()
+
+    def schedule(self):
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.delay, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        asyncio.ensure_future(self._flush_logged())
+
+    async def _flush_logged(self):
+        try:
+            await self.flush()
+        except Exception:
+            logger.exception("Write-behind flush failed")
+
+    async def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        async with self._lock:
+            await asyncio.get_running_loop().run_in_executor(get_executor("fs"), self._flush)
+
+
 class SerialMixin:
     _serial_count = 0
 
@@ -0,0 +1,124 @@
+import contextlib
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+
+
+# The span of the D-Bus call being processed, executors charge their wait and run times to it
+current_span = contextvars.ContextVar("current_span", default=None)
+
+MAX_BYTES = 10 * 2**20
+BACKUP_COUNT = 3
+
+
+class Span:
+    def __init__(self, method, sender, path):
+        self.method = method
+        self.sender = sender
+        self.path = path
+        self.start = time.time()
+        self.duration = None
+        self.error = False
+        # Seconds by executor, updated from the worker threads
+        self.waited = {}
+        self.ran = {}
+        self._lock = threading.Lock()
+
+    def add(self, executor, waited, ran):
+        with self._lock:
+            self.waited[executor] = self.waited.get(executor, 0.0) + waited
+            self.ran[executor] = self.ran.get(executor, 0.0) + ran
+
+    def record(self):
+        with self._lock:
+            return {
+                "ts": self.start,
+                "method": self.method,
+                "sender": self.sender,
+                "path": self.path,
+                "total_ms": self.duration * 1000,
+                "wait_ms": {executor: seconds * 1000 for executor, seconds in self.waited.items()},
+                "run_ms": {executor: seconds * 1000 for executor, seconds in self.ran.items()},
+                "error": self.error,
+            }
+
+
+class _ChromeTraceHandler(logging.handlers.RotatingFileHandler):
+    # Every file is a JSON array of trace events; chrome://tracing and Perfetto accept it without the closing bracket
+    def _open(self):
+        stream = super()._open()
+        if stream.tell() == 0:
+            stream.write("[\n")
+        return stream
+
+
+class Tracer:
+    # Writes one record per span to a rotating file, on a background thread
+    def __init__(self, path, trace_format="jsonl", max_bytes=MAX_BYTES, backup_count=BACKUP_COUNT):
+        self.trace_format = trace_format
+        handler_class = _ChromeTraceHandler if trace_format == "chrome" else logging.handlers.RotatingFileHandler
+        handler = handler_class(path, maxBytes=max_bytes, backupCount=backup_count)
+        handler.terminator = ",\n" if trace_format == "chrome" else "\n"
+        self._queue = queue.SimpleQueue()
+        self._listener = logging.handlers.QueueListener(self._queue, handler)
+        self._listener.start()
+        self._pid = os.getpid()
+
+    def _format(self, span):
+        record = span.record()
+        if self.trace_format == "chrome":
+            record = {
+                "name": span.method,
+                "cat": "dbus",
+                "ph": "X",
+                "ts": record.pop("ts") * 10**6,
+                "dur": record.pop("total_ms") * 1000,
+                "pid": self._pid,
+                "tid": 0,
+                "args": record,
+            }
+        return json.dumps(record, sort_keys=True)
+
+    def emit(self, span):
+        self._queue.put(logging.makeLogRecord({"msg": self._format(span)}))
+
+    @contextlib.contextmanager
+    def span(self, method, message):
+        span = Span(method, message.sender if message else None, message.path if message else None)
+        token = current_span.set(span)
+        start = time.perf_counter()
+        try:
+            yield span
+        except BaseException:
+            span.error = True
+            raise
+        finally:
+            span.duration = time.perf_counter() - start
+            current_span.reset(token)
+            self.emit(span)
+
+    def close(self):
+        self._listener.stop()
+        for handler in self._listener.handlers:
+            handler.close()
+
+
+tracer = None
+
+
+def configure_tracing(path, trace_format="jsonl"):
+    global tracer
+    if tracer is not None:
+        tracer.close()
+    tracer = Tracer(path, trace_format) if path else None
+
+
+def span(method, message):
+    if tracer is None:
+        return contextlib.nullcontext()
+    return tracer.span(method, message)
@@ -0,0 +1,154 @@
+import asyncio
+import ctypes
+import ctypes.util
+import logging
+import os
+import struct
+import time
+
+
+logger = logging.getLogger(__name__)
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_ONLYDIR | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class Watcher:
+    # Watches the store directory, its collection directories and their shard directories with inotify.
+    # Changes are collected per collection and handed to `callback` in debounced batches,
+    # either as {collection_name: {file_name, ...} or None} or as None, meaning everything may have changed.
+
+    def __init__(self, base_path, callback, delay=0.5, max_delay=5.0):
+        self.base_path = base_path
+        self.callback = callback
+        self.delay = delay
+        self.max_delay = max_delay
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = None
+        self._watches = {}
+        self._shard_watches = set()
+        self._changes = {}
+        self._first_change = None
+        self._timer = None
+
+    def _add_watch(self, path, collection_name):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            logger.warning("Cannot watch %s: %s", path, os.strerror(ctypes.get_errno()))
+            return
+        self._watches[wd] = collection_name
+        return wd
+
+    def _add_shard_watch(self, path, collection_name):
+        wd = self._add_watch(path, collection_name)
+        if wd is not None:
+            self._shard_watches.add(wd)
+
+    def _add_collection_watch(self, path, collection_name):
+        self._add_watch(path, collection_name)
+        for entry in os.scandir(path):
+            if entry.is_dir() and not entry.name.startswith("."):
+                self._add_shard_watch(entry.path, collection_name)
+
+    def start(self):
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        self._add_watch(self.base_path, None)
+        for entry in os.scandir(self.base_path):
+            if entry.is_dir() and not entry.name.startswith("."):
+                self._add_collection_watch(entry.path, entry.name)
+        asyncio.get_running_loop().add_reader(self._fd, self._read)
+
+    def stop(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._fd is not None:
+            asyncio.get_running_loop().remove_reader(self._fd)
+            os.close(self._fd)
+            self._fd = None
+
+    def _read(self):
+        try:
+            buffer = os.read(self._fd, 0x10000)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(buffer, offset)
+            start = offset + EVENT_HEADER.size
+            offset = start + length
+            name = os.fsdecode(buffer[start:offset].rstrip(b"\0"))
+            self._handle_event(wd, mask, name)
+        if self._changes is None or self._changes:
+            self._schedule()
+
+    def _handle_event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            # Events were lost
+            self._changes = None
+            return
+        if mask & IN_IGNORED:
+            self._watches.pop(wd, None)
+            self._shard_watches.discard(wd)
+            return
+        if wd not in self._watches:
+            return
+        collection_name = self._watches[wd]
+        if collection_name is None:
+            if not mask & IN_ISDIR or name.startswith("."):
+                return
+            # A collection directory appeared or vanished
+            collection_name = name
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                try:
+                    self._add_collection_watch(os.path.join(self.base_path, name), name)
+                except FileNotFoundError:
+                    pass
+            name = None
+        elif mask & IN_ISDIR and wd not in self._shard_watches:
+            if name.startswith("."):
+                return
+            # A shard directory of a sharded collection appeared or vanished
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self._add_shard_watch(os.path.join(self.base_path, collection_name, name), collection_name)
+            name = None
+        if self._changes is not None:
+            if name is None:
+                # Files may have come or gone with the directory unseen
+                self._changes[collection_name] = None
+            else:
+                names = self._changes.setdefault(collection_name, set())
+                if names is not None:
+                    names.add(name)
+
+    def _schedule(self):
+        # Restart the timer on every burst, but flush at least every max_delay seconds
+        now = time.monotonic()
+        if self._first_change is None:
+            self._first_change = now
+        if self._timer is not None:
+            self._timer.cancel()
+        delay = min(self.delay, max(self._first_change + self.max_delay - now, 0))
+        self._timer = asyncio.get_running_loop().call_later(delay, self._flush)
+
+    def _flush(self):
+        changes = self._changes
+        self._changes = {}
+        self._first_change = None
+        self._timer = None
+        self.callback(changes)
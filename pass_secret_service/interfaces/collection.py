@@ -1,5 +1,9 @@
 # Implementation of the org.freedesktop.Secret.Collection interface
 
+import contextlib
+import logging
+import time
+
 from dbus_next import Variant
 
 from dbus_next.service import (
@@ -10,11 +14,28 @@ from dbus_next.service import (
     signal,
 )
 
-from pass_secret_service.common.names import base_path, COLLECTION_LABEL, ITEM_LABEL, ITEM_ATTRIBUTES
-from pass_secret_service.common.tools import run_in_executor
-from pass_secret_service.interfaces.item import Item
+from pass_secret_service.common.exceptions import DBusErrorFailed, DBusErrorIsLocked, DBusErrorNoSuchObject
+from pass_secret_service.common.index import AttributeIndex
+from pass_secret_service.common.metrics import timed_methods
+from pass_secret_service.common.names import (
+    base_path,
+    collection_interface,
+    COLLECTION_CREATED,
+    COLLECTION_LABEL,
+    COLLECTION_MODIFIED,
+    ITEM_ATTRIBUTES,
+    ITEM_CREATED,
+    ITEM_LABEL,
+    ITEM_MODIFIED,
+)
+from pass_secret_service.common.tools import emit_batched, gather_bounded, LockTable, run_in_executor, RWLock
+from pass_secret_service.interfaces.item import Item, LockedItemInterface
+
 
+logger = logging.getLogger(__name__)
 
+
+@timed_methods("org.freedesktop.Secret.Collection")
 class Collection(ServiceInterface):
     @staticmethod
     @run_in_executor
@@ -23,6 +44,8 @@ class Collection(ServiceInterface):
 
     @classmethod
     async def _create(cls, service, properties):
+        now = int(time.time())
+        properties = {**properties, COLLECTION_CREATED: now, COLLECTION_MODIFIED: now}
         id = await cls._create_in_store(service, properties)
         instance = await cls._init(service, id)
         service.CollectionCreated(instance)
@@ -30,24 +53,77 @@ class Collection(ServiceInterface):
 
     @run_in_executor
     def _delete_from_store(self):
-        self.pass_store.delete_collection(self.id)
+        self.pass_store.trash_collection(self.id)
 
-    def _lock(self):
-        self.locked = True
+    @run_in_executor
+    def _evict_from_store(self):
+        self.pass_store.evict_collection(self.id)
 
-    def _unlock(self):
-        self.locked = False
+    @run_in_executor
+    def _load_properties_from_store(self):
+        return self.pass_store.backfill_collection_timestamps(self.id, self.pass_store.get_collection_properties(self.id))
+
+    @run_in_executor
+    def _load_items_from_store(self):
+        return self.pass_store.backfill_item_timestamps(self.id, self.pass_store.get_items_properties(self.id))
+
+    @run_in_executor
+    def _load_changed_items_from_store(self, item_ids):
+        return self.pass_store.get_changed_items_properties(self.id, item_ids)
+
+    def _set_locked(self, locked):
+        self.locked = locked
+        self.service.CollectionChanged(self)
+        self.emit_properties_changed({"Locked": locked})
+
+    async def _lock(self):
+        # Only the collection itself stays in memory, its items are loaded again on unlock
+        async with self.rwlock.write():
+            if self.locked:
+                return
+            self._set_locked(True)
+            # Item paths and metadata stay in memory, so clients can still find, inspect and unlock them
+            self.locked_items = {item.id: item.properties for item in self.items.values()}
+            self.locked_index = AttributeIndex()
+            for item in self.items.values():
+                self.locked_index.add(item.path, item.attributes)
+            self._detach_items()
+            await self._evict_from_store()
+
+    async def _unlock(self):
+        async with self.rwlock.write():
+            if not self.locked:
+                return
+            items_properties = await self._load_items_from_store()
+            self._unexport_locked_items()
+            for item_id, properties in items_properties.items():
+                await Item._init(self, item_id, properties)
+            self.locked_items = {}
+            self.locked_index = AttributeIndex()
+            self._set_locked(False)
 
     def _search_items(self, attributes):
-        results = []
-        for item in self.items.values():
-            if item._has_attributes(attributes):
-                results.append(item.path)
-        return results
+        if self.locked:
+            return self.locked_index.search(attributes)
+        return [item.path for item in self.index.search(attributes)]
+
+    def _export_locked_item(self, item_id):
+        # Placeholders are exported lazily like items, on the first call addressing them
+        properties = self.locked_items.get(item_id)
+        if properties is not None and item_id not in self.locked_interfaces:
+            interface = LockedItemInterface(self.path + "/" + item_id, properties)
+            self.bus.export(interface.path, interface)
+            self.locked_interfaces[item_id] = interface
+
+    def _unexport_locked_items(self):
+        for interface in self.locked_interfaces.values():
+            self.bus.unexport(interface.path)
+        self.locked_interfaces = {}
 
     async def _unregister(self):
         for item in self.items.values():
             await item._unregister()
+        self._unexport_locked_items()
         self.bus.unexport(self.path)
 
     def __init__(self, service, id):
@@ -58,33 +134,42 @@ class Collection(ServiceInterface):
         self.id = id
         self.path = base_path + "/collection/" + self.id
         self.locked = False
+        self.locked_items = {}
+        self.locked_index = AttributeIndex()
+        self.locked_interfaces = {}
+        # Lock order: replace locks, then the collection lock, then item locks by id.
+        # Item operations share the collection lock, locking, unlocking and deleting the collection hold it exclusively.
+        self.rwlock = RWLock()
+        self.item_locks = LockTable(RWLock)
+        # Serializes CreateItem with replace per set of attributes, so concurrent calls end up with a single item
+        self.replace_locks = LockTable()
         self.items = {}
+        self.index = AttributeIndex()
+        self.extension = CollectionExtension(self)
 
     @run_in_executor
-    def _get_collection_properties(self):
-        return self.pass_store.get_collection_properties(self.id)
-
-    @run_in_executor
-    def _get_items(self):
-        return self.pass_store.get_items(self.id)
+    def _load_from_store(self):
+        # Read everything in one executor task
+        properties = self.pass_store.backfill_collection_timestamps(self.id, self.pass_store.get_collection_properties(self.id))
+        return properties, self.pass_store.backfill_item_timestamps(self.id, self.pass_store.get_items_properties(self.id))
 
     @classmethod
     async def _init(cls, service, id):
         self = cls(service, id)
-        self.properties = await self._get_collection_properties()
-        for item_id in await self._get_items():
-            await Item._init(self, item_id)
+        self.properties, items_properties = await self._load_from_store()
+        if self.id in self.service.collections:
+            # Registered concurrently, e.g. by a resync with the store
+            return self.service.collections[self.id]
+        for item_id, properties in items_properties.items():
+            await Item._init(self, item_id, properties)
         # Register with dbus
         self.pub_ref = self.bus.export(self.path, self)
+        self.bus.export(self.path, self.extension)
         # Register with service
         self.service.collections[self.id] = self
         return self
 
-    @method()
-    async def Delete(self) -> "o":
-        # Delete items
-        for item in list(self.items.values()):
-            await item._delete()
+    async def _detach(self):
         # Remove stale aliases
         deleted_aliases = [name for name, alias in self.service.aliases.items() if alias["collection"] == self]
         await self.service._set_aliases({name: None for name in deleted_aliases})
@@ -92,10 +177,179 @@ class Collection(ServiceInterface):
         self.service.collections.pop(self.id)
         # Deregister from dbus
         await self._unregister()
-        # Remove from disk
-        await self._delete_from_store()
-        # Signal deletion
-        self.service.CollectionDeleted(self)
+
+    @run_in_executor
+    def _prepare_items(self, properties_list):
+        return self.pass_store.prepare_items(self.id, properties_list)
+
+    @run_in_executor
+    def _discard_items(self, names):
+        self.pass_store.discard_items(self.id, names)
+
+    @run_in_executor(pool="gpg")
+    def _set_item_password(self, name, password):
+        self.pass_store.set_item_password(self.id, name, password)
+
+    async def _set_item_passwords(self, passwords):
+        # Returns the names whose password could not be set
+        async def set_password(name, password):
+            try:
+                await self._set_item_password(name, password)
+            except Exception:
+                logger.warning("Failed to set the password of %s/%s", self.id, name, exc_info=True)
+                return name
+
+        failed = await gather_bounded(self.service.max_parallel_encrypts, (set_password(*entry) for entry in passwords.items()))
+        return [name for name in failed if name is not None]
+
+    async def _create_items(self, entries, replace):
+        async with contextlib.AsyncExitStack() as stack:
+            if replace:
+                keys = {tuple(sorted(properties.get(ITEM_ATTRIBUTES, Variant("a{ss}", {})).value.items())) for properties, secret in entries}
+                for key in sorted(keys):
+                    await stack.enter_async_context(self.replace_locks[key])
+            await stack.enter_async_context(self.rwlock.read())
+            if self.locked:
+                raise DBusErrorIsLocked(self.path)
+            return await self._create_items_locked(stack, entries, replace)
+
+    async def _create_items_locked(self, stack, entries, replace):
+        # Bulk CreateItem: new items are encrypted in parallel and created all or nothing,
+        # signals are emitted once per item when the whole batch is done
+        passwords = [await self.service._decode_secret(secret) for properties, secret in entries]
+        existing = {}
+        if replace:
+            for properties, secret in entries:
+                attributes = properties.get(ITEM_ATTRIBUTES, Variant("a{ss}", {})).value
+                items = self.index.search(attributes)
+                if items:
+                    existing[tuple(sorted(attributes.items()))] = items[0]
+            for item in sorted(set(existing.values()), key=lambda item: item.id):
+                await stack.enter_async_context(self.item_locks[item.id].write())
+            # Items deleted while waiting are created anew
+            existing = {key: item for key, item in existing.items() if self.items.get(item.id) is item}
+        # Every entry either replaces an existing item or becomes a new one, keyed for deduplication
+        targets = []
+        new_entries = {}
+        replaced = {}
+        now = int(time.time())
+        for (properties, secret), password in zip(entries, passwords):
+            properties = {**{k: v.value for k, v in properties.items()}, ITEM_CREATED: now, ITEM_MODIFIED: now}
+            if replace:
+                key = tuple(sorted(properties.get(ITEM_ATTRIBUTES, {}).items()))
+                if key in existing:
+                    replaced[existing[key]] = (properties, password)
+                    targets.append((None, existing[key]))
+                    continue
+                # Later entries with the same attributes replace earlier ones of the same call
+            else:
+                key = len(targets)
+            new_entries[key] = (properties, password)
+            targets.append((key, None))
+        # New items
+        names = await self._prepare_items([properties for properties, password in new_entries.values()])
+        failed = await self._set_item_passwords({name: password for name, (properties, password) in zip(names, new_entries.values())})
+        if failed:
+            await self._discard_items(names)
+            raise DBusErrorFailed("Failed to create {} of {} items.".format(len(failed), len(names)))
+        created = {}
+        for key, name, (properties, password) in zip(new_entries, names, new_entries.values()):
+            created[key] = await Item._init(self, name, properties)
+        # Replaced items
+        failed = await self._set_item_passwords({item.id: password for item, (properties, password) in replaced.items()})
+        for item, (properties, password) in replaced.items():
+            item._evict_password()
+            # Items whose secret could not be replaced keep their modification time
+            modified = item.modified if item.id in failed else now
+            item._save_properties({ITEM_LABEL: properties.get(ITEM_LABEL, ""), ITEM_MODIFIED: modified})
+            if item.interface is not None:
+                item.interface.emit_properties_changed({"Label": item.label, "Modified": modified})
+        await emit_batched(self.bus, self.ItemCreated, created.values())
+        await emit_batched(self.bus, self.ItemChanged, replaced)
+        if failed:
+            raise DBusErrorFailed("Failed to replace the secrets of {} of {} items.".format(len(failed), len(replaced)))
+        return [(item or created[key]).path for key, item in targets]
+
+    async def _resync(self, names=None):
+        async with self.rwlock.write():
+            await self._resync_locked(names)
+
+    async def _resync_locked(self, names):
+        # Apply changes made to the store by others. `names` are the files that changed,
+        # only their items are read again; None or no names means anything in the collection may have changed.
+        if names:
+            if ".properties" in names:
+                self._apply_properties(await self._load_properties_from_store())
+            if not self.locked:
+                item_ids = {name.rsplit(".", 1)[0] for name in names if not name.startswith(".") and name.endswith((".gpg", ".properties"))}
+                await self._apply_items_properties(await self._load_changed_items_from_store(item_ids), names)
+            return
+        if self.locked:
+            # Items of a locked collection are picked up on unlock
+            self._apply_properties(await self._load_properties_from_store())
+            return
+        properties, items_properties = await self._load_from_store()
+        self._apply_properties(properties)
+        # Items missing from the store are gone
+        await self._apply_items_properties({**dict.fromkeys(self.items), **items_properties}, names)
+
+    def _apply_properties(self, properties):
+        if properties != self.properties:
+            self.properties = properties
+            self.service.CollectionChanged(self)
+
+    async def _apply_items_properties(self, items_properties, names):
+        # Signals are sent once all changes are applied, paced so that a large external change does not flood the bus
+        deleted = []
+        created = []
+        changed = []
+        for item_id, properties in items_properties.items():
+            item = self.items.get(item_id)
+            if properties is None:
+                if item is not None:
+                    await item._detach()
+                    item._evict_password()
+                    deleted.append(item)
+            elif item is None:
+                created.append(await Item._init(self, item_id, properties))
+            else:
+                if names is None or item_id + ".gpg" in names:
+                    item._evict_password()
+                if properties != item.properties:
+                    item._update_properties(properties)
+                    changed.append(item)
+        await emit_batched(self.bus, self.ItemDeleted, deleted)
+        await emit_batched(self.bus, self.ItemCreated, created)
+        await emit_batched(self.bus, Item._emit_changed, changed)
+
+    def _detach_items(self):
+        # Detach all items at once, their files go with the collection directory
+        items = list(self.items.values())
+        self.items = {}
+        self.index = AttributeIndex()
+        for item in items:
+            if item.interface is not None:
+                self.bus.unexport(item.path)
+                item.interface = None
+            self.service.decryptions.forget((self.id, item.id))
+        if self.service.secret_cache is not None:
+            self.service.secret_cache.evict_collection(self.id)
+        return items
+
+    @method()
+    async def Delete(self) -> "o":
+        async with self.rwlock.write():
+            if self.service.collections.get(self.id) is not self:
+                # Deleted while waiting
+                raise DBusErrorNoSuchObject(self.path)
+            items = self._detach_items()
+            # Remove from disk, the directory is only renamed here and purged in the background
+            await self._delete_from_store()
+            self.service._purge_collections()
+            # Signal deletion while the collection is still exported
+            await emit_batched(self.bus, self.ItemDeleted, items)
+            await self._detach()
+            self.service.CollectionDeleted(self)
         prompt = "/"
         return prompt
 
@@ -106,17 +360,25 @@ class Collection(ServiceInterface):
     @method()
     async def CreateItem(self, properties: "a{sv}", secret: "(oayays)", replace: "b") -> "oo":
         prompt = "/"
-        if replace:
-            attributes = properties.get(ITEM_ATTRIBUTES, Variant("a{ss}", {})).value
-            repl_items = self._search_items(attributes)
-            if len(repl_items):
-                item = self.service._get_item_from_path(repl_items[0])
-                item.Label = properties.get(ITEM_LABEL, Variant("s", "")).value
-                await item._set_secret(secret)
-                return [item.path, prompt]
-        password = await self.service._decode_secret(secret)
-        item = await Item._create(self, password, properties)
-        return [item.path, prompt]
+        attributes = properties.get(ITEM_ATTRIBUTES, Variant("a{ss}", {})).value
+        async with contextlib.AsyncExitStack() as stack:
+            if replace:
+                await stack.enter_async_context(self.replace_locks[tuple(sorted(attributes.items()))])
+            await stack.enter_async_context(self.rwlock.read())
+            if self.locked:
+                raise DBusErrorIsLocked(self.path)
+            repl_items = self.index.search(attributes) if replace else []
+            if repl_items:
+                item = repl_items[0]
+                async with self.item_locks[item.id].write():
+                    # Unless it was deleted while waiting, otherwise it is created anew
+                    if self.items.get(item.id) is item:
+                        item._set_label(properties.get(ITEM_LABEL, Variant("s", "")).value)
+                        await item._set_secret(secret)
+                        return [item.path, prompt]
+            password = await self.service._decode_secret(secret)
+            item = await Item._create(self, password, properties)
+            return [item.path, prompt]
 
     @signal()
     def ItemCreated(self, item) -> "o":
@@ -132,6 +394,8 @@ class Collection(ServiceInterface):
 
     @dbus_property(access=PropertyAccess.READ)
     def Items(self) -> "ao":
+        if self.locked:
+            return self.locked_index.search({})
         return [item.path for item in self.items.values()]
 
     @dbus_property(access=PropertyAccess.READWRITE)
@@ -141,7 +405,9 @@ class Collection(ServiceInterface):
     @Label.setter
     def Label(self, label: "s"):
         if self.Label != label:
-            self.properties = self.pass_store.update_collection_properties(self.id, {COLLECTION_LABEL: label})
+            self.properties = {**self.properties, COLLECTION_LABEL: label, COLLECTION_MODIFIED: int(time.time())}
+            self.pass_store.queue_collection_properties(self.id, self.properties)
+            self.service.write_behind.schedule()
             self.service.CollectionChanged(self)
 
     @dbus_property(access=PropertyAccess.READ)
@@ -150,8 +416,27 @@ class Collection(ServiceInterface):
 
     @dbus_property(access=PropertyAccess.READ)
     def Created(self) -> "t":
-        return 0
+        return self.properties.get(COLLECTION_CREATED, 0)
 
     @dbus_property(access=PropertyAccess.READ)
     def Modified(self) -> "t":
-        return 0
+        return self.properties.get(COLLECTION_MODIFIED, 0)
+
+
+@timed_methods(collection_interface)
+class CollectionExtension(ServiceInterface):
+    # Vendor methods of a collection, exported next to it
+    def __init__(self, collection):
+        super().__init__(collection_interface)
+        self.collection = collection
+
+    @method()
+    async def CreateItems(self, items: "a(a{sv}(oayays))", replace: "b") -> "ao":
+        return await self.collection._create_items(items, replace)
+
+    @method()
+    async def GetTimestamps(self) -> "a{o(tt)}":
+        # Created and Modified of all items at once, from the metadata held in memory
+        if self.collection.locked:
+            raise DBusErrorIsLocked(self.collection.path)
+        return {item.path: [item.created, item.modified] for item in self.collection.items.values()}
@@ -1,5 +1,10 @@
 # Implementation of the org.freedesktop.Secret.Item interface
 
+import asyncio
+import contextlib
+import sys
+import time
+
 from dbus_next.service import (
     dbus_property,
     method,
@@ -7,13 +12,27 @@ from dbus_next.service import (
     ServiceInterface,
 )
 
-from pass_secret_service.common.names import base_path, ITEM_LABEL, ITEM_ATTRIBUTES
-from pass_secret_service.common.tools import run_in_executor
+from pass_secret_service.common.exceptions import DBusErrorIsLocked, DBusErrorNoSuchObject
+from pass_secret_service.common.metrics import timed_methods
+from pass_secret_service.common.names import base_path, ITEM_LABEL, ITEM_ATTRIBUTES, ITEM_CREATED, ITEM_MODIFIED
+from pass_secret_service.common.tools import get_executor, run_in_executor
+
+
+def _intern_properties(properties):
+    # Attribute names and values like "xdg:schema" repeat across many items, keep a single copy of each
+    properties = {sys.intern(key): value for key, value in properties.items()}
+    attributes = properties.get(ITEM_ATTRIBUTES)
+    if attributes:
+        properties[ITEM_ATTRIBUTES] = {sys.intern(key): sys.intern(value) if isinstance(value, str) else value for key, value in attributes.items()}
+    return properties
 
 
-class Item(ServiceInterface):
+class Item:
+    # Items are compact records; the D-Bus interface is only created and exported on first access
+    __slots__ = ("collection", "id", "properties", "interface")
+
     @classmethod
-    @run_in_executor
+    @run_in_executor(pool="gpg")
     def _create_in_store(cls, collection, password, properties):
         return collection.service.pass_store.create_item(collection.id, password, properties)
 
@@ -23,6 +42,8 @@ class Item(ServiceInterface):
             properties = {}
         else:
             properties = {k: v.value for k, v in properties.items()}
+        now = int(time.time())
+        properties = {**properties, ITEM_CREATED: now, ITEM_MODIFIED: now}
         id = await cls._create_in_store(collection, password, properties)
         instance = await cls._init(collection, id)
         collection.ItemCreated(instance)
@@ -32,83 +53,261 @@ class Item(ServiceInterface):
     def _delete_from_store(self):
         self.service.pass_store.delete_item(self.collection.id, self.id)
 
-    async def _delete(self):
+    @contextlib.asynccontextmanager
+    async def _locked(self, write=False):
+        # Shares the collection lock, then takes the item lock; always in this order.
+        # Callers must not hold either of them already.
+        async with self.collection.rwlock.read():
+            lock = self.collection.item_locks[self.id]
+            async with lock.write() if write else lock.read():
+                if self.collection.items.get(self.id) is not self:
+                    # Deleted while waiting
+                    raise DBusErrorNoSuchObject(self.path)
+                yield
+
+    async def _detach(self):
         # Deregister from collection
         self.collection.items.pop(self.id)
+        self._unindex()
         # Deregister from dbus
         await self._unregister()
+
+    async def _delete(self):
+        await self._detach()
         # Remove from disk
         await self._delete_from_store()
+        self._evict_password()
         # Signal deletion
         self.collection.ItemDeleted(self)
 
-    def _has_attributes(self, attributes):
-        attrs = self.Attributes
-        for key, value in attributes.items():
-            if key not in attrs or attrs[key] != value:
-                return False
-        return True
+    def _index(self):
+        self.collection.index.add(self, self.attributes)
 
-    @run_in_executor
-    def _get_password(self):
-        return self.pass_store.get_item_password(self.collection.id, self.id)
+    def _unindex(self):
+        self.collection.index.remove(self)
+
+    async def _decrypt_password(self):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(get_executor("gpg"), self.pass_store.get_item_password, self.collection.id, self.id)
+
+    async def _load_password(self, key):
+        cache = self.service.secret_cache
+        if cache is None:
+            return await self._decrypt_password()
+        generation = cache.generation
+        password = await self._decrypt_password()
+        cache.put(key, password, generation)
+        return password
+
+    async def _get_password(self):
+        key = (self.collection.id, self.id)
+        cache = self.service.secret_cache
+        if cache is not None:
+            password = cache.get(key)
+            if password is not None:
+                return password
+        # Concurrent requests for the same item share one decryption
+        return await self.service.decryptions.run(key, self._load_password, key)
+
+    async def _read_password(self):
+        async with self._locked():
+            return await self._get_password()
+
+    def _evict_password(self):
+        key = (self.collection.id, self.id)
+        self.service.decryptions.forget(key)
+        if self.service.secret_cache is not None:
+            self.service.secret_cache.evict(key)
 
     async def _get_secret(self, session):
         password = await self._get_password()
         return await self.service._encode_secret(session, password)
 
-    @run_in_executor
+    @run_in_executor(pool="gpg")
     def _set_password(self, password):
         return self.pass_store.set_item_password(self.collection.id, self.id, password)
 
     async def _set_secret(self, secret):
         password = await self.service._decode_secret(secret)
         await self._set_password(password)
+        self._evict_password()
+        self._save_properties({ITEM_MODIFIED: int(time.time())})
         self.collection.ItemChanged(self)
+        if self.interface is not None:
+            self.interface.emit_properties_changed({"Modified": self.modified})
+
+    @property
+    def attributes(self):
+        return self.properties.get(ITEM_ATTRIBUTES, {})
+
+    def _save_properties(self, new_properties):
+        self.properties = _intern_properties({**self.properties, **new_properties})
+        self.pass_store.queue_item_properties(self.collection.id, self.id, self.properties)
+        self.service.write_behind.schedule()
+
+    def _set_attributes(self, attributes):
+        if self.attributes != attributes:
+            self._save_properties({ITEM_ATTRIBUTES: attributes, ITEM_MODIFIED: int(time.time())})
+            self._index()
+            self.collection.ItemChanged(self)
+            if self.interface is not None:
+                self.interface.emit_properties_changed({"Attributes": attributes, "Modified": self.modified})
+
+    @property
+    def label(self):
+        return str(self.properties.get(ITEM_LABEL, ""))
+
+    def _set_label(self, label):
+        if self.label != label:
+            self._save_properties({ITEM_LABEL: label, ITEM_MODIFIED: int(time.time())})
+            self.collection.ItemChanged(self)
+            if self.interface is not None:
+                self.interface.emit_properties_changed({"Label": label, "Modified": self.modified})
+
+    @property
+    def created(self):
+        return self.properties.get(ITEM_CREATED, 0)
+
+    @property
+    def modified(self):
+        return self.properties.get(ITEM_MODIFIED, 0)
+
+    def _update_properties(self, properties):
+        # Apply properties changed on disk, the caller signals the change
+        self.properties = _intern_properties(properties)
+        self._index()
+
+    def _emit_changed(self):
+        self.collection.ItemChanged(self)
+        if self.interface is not None:
+            self.interface.emit_properties_changed({"Label": self.label, "Attributes": self.attributes, "Modified": self.modified})
+
+    def _export(self):
+        if self.interface is None:
+            self.interface = ItemInterface(self)
+            self.bus.export(self.path, self.interface)
+        return self.interface
 
     async def _unregister(self):
-        self.bus.unexport(self.path)
+        if self.interface is not None:
+            self.bus.unexport(self.path)
+            self.interface = None
 
     def __init__(self, collection, id):
-        super().__init__("org.freedesktop.Secret.Item")
         self.collection = collection
-        self.service = self.collection.service
-        self.bus = self.service.bus
-        self.pass_store = self.service.pass_store
         self.id = id
-        self.path = self.collection.path + "/" + self.id
+        self.interface = None
+
+    @property
+    def service(self):
+        return self.collection.service
+
+    @property
+    def bus(self):
+        return self.collection.bus
+
+    @property
+    def pass_store(self):
+        return self.collection.pass_store
+
+    @property
+    def path(self):
+        return self.collection.path + "/" + self.id
 
     @run_in_executor
     def _get_item_properties(self):
         return self.pass_store.get_item_properties(self.collection.id, self.id)
 
     @classmethod
-    async def _init(cls, collection, id):
+    async def _init(cls, collection, id, properties=None):
         self = cls(collection, id)
-        self.properties = await self._get_item_properties()
-        # Register with dbus
-        self.bus.export(self.path, self)
+        if properties is None:
+            properties = await self._get_item_properties()
+        if self.id in self.collection.items:
+            # Registered concurrently, e.g. by a resync with the store
+            return self.collection.items[self.id]
+        self.properties = _intern_properties(properties)
         # Register with collection
         self.collection.items[self.id] = self
+        self._index()
         return self
 
+
+@timed_methods("org.freedesktop.Secret.Item")
+class ItemInterface(ServiceInterface):
+    def __init__(self, item):
+        super().__init__("org.freedesktop.Secret.Item")
+        self.item = item
+
     @method()
     async def Delete(self) -> "o":
-        await self._delete()
+        async with self.item._locked(write=True):
+            await self.item._delete()
         prompt = "/"
         return prompt
 
     @method()
     async def GetSecret(self, session: "o") -> "(oayays)":
-        return await self._get_secret(session)
+        async with self.item._locked():
+            return await self.item._get_secret(session)
+
+    @method()
+    async def SetSecret(self, secret: "(oayays)"):
+        async with self.item._locked(write=True):
+            await self.item._set_secret(secret)
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Locked(self) -> "b":
+        return self.item.collection.locked
+
+    @dbus_property(access=PropertyAccess.READWRITE)
+    def Attributes(self) -> "a{ss}":
+        return self.item.attributes
+
+    @Attributes.setter
+    def Attributes(self, attributes: "a{ss}"):
+        self.item._set_attributes(attributes)
+
+    @dbus_property(access=PropertyAccess.READWRITE)
+    def Label(self) -> "s":
+        return self.item.label
+
+    @Label.setter
+    def Label(self, label: "s"):
+        self.item._set_label(label)
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Created(self) -> "t":
+        return self.item.created
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Modified(self) -> "t":
+        return self.item.modified
+
+
+@timed_methods("org.freedesktop.Secret.Item")
+class LockedItemInterface(ServiceInterface):
+    # Stands in for an item of a locked collection: its metadata stays readable, everything else is refused
+    def __init__(self, path, properties):
+        super().__init__("org.freedesktop.Secret.Item")
+        self.path = path
+        self.properties = properties
+
+    @method()
+    async def Delete(self) -> "o":
+        raise DBusErrorIsLocked(self.path)
+
+    @method()
+    async def GetSecret(self, session: "o") -> "(oayays)":
+        raise DBusErrorIsLocked(self.path)
 
     @method()
     async def SetSecret(self, secret: "(oayays)"):
-        await self._set_secret(secret)
+        raise DBusErrorIsLocked(self.path)
 
     @dbus_property(access=PropertyAccess.READ)
     def Locked(self) -> "b":
-        return False
+        return True
 
     @dbus_property(access=PropertyAccess.READWRITE)
     def Attributes(self) -> "a{ss}":
@@ -116,10 +315,7 @@ class Item(ServiceInterface):
 
     @Attributes.setter
     def Attributes(self, attributes: "a{ss}"):
-        if self.Attributes != attributes:
-            self.properties = self.pass_store.update_item_properties(self.collection.id, self.id, {ITEM_ATTRIBUTES: attributes})
-            self.collection.ItemChanged(self)
-            self.emit_properties_changed({"Attributes": attributes})
+        raise DBusErrorIsLocked(self.path)
 
     @dbus_property(access=PropertyAccess.READWRITE)
     def Label(self) -> "s":
@@ -127,15 +323,12 @@ class Item(ServiceInterface):
 
     @Label.setter
     def Label(self, label: "s"):
-        if self.Label != label:
-            self.properties = self.pass_store.update_item_properties(self.collection.id, self.id, {ITEM_LABEL: label})
-            self.collection.ItemChanged(self)
-            self.emit_properties_changed({"Label": label})
+        raise DBusErrorIsLocked(self.path)
 
     @dbus_property(access=PropertyAccess.READ)
     def Created(self) -> "t":
-        return 0
+        return self.properties.get(ITEM_CREATED, 0)
 
     @dbus_property(access=PropertyAccess.READ)
     def Modified(self) -> "t":
-        return 0
+        return self.properties.get(ITEM_MODIFIED, 0)
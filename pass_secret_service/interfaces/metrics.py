@@ -0,0 +1,20 @@
+# Vendor interface exposing the service's own metrics
+
+import json
+
+from dbus_next.service import (
+    method,
+    ServiceInterface,
+)
+
+from pass_secret_service.common.names import metrics_interface
+
+
+class MetricsInterface(ServiceInterface):
+    def __init__(self, service):
+        super().__init__(metrics_interface)
+        self.service = service
+
+    @method()
+    def GetStats(self) -> "s":
+        return json.dumps(self.service._stats(), sort_keys=True)
@@ -1,5 +1,9 @@
 # Implementation of the org.freedesktop.Secret.Service interface
 
+import asyncio
+import logging
+import time
+
 from dbus_next.service import (
     dbus_property,
     method,
@@ -7,19 +11,40 @@ from dbus_next.service import (
     ServiceInterface,
     signal,
 )
-from dbus_next import Variant
+from dbus_next import DBusError, Message, MessageType, Variant
 
+from pass_secret_service.common.cache import SecretCache
 from pass_secret_service.common.exceptions import (
+    DBusErrorFailed,
+    DBusErrorIsLocked,
     DBusErrorNotSupported,
     DBusErrorNoSuchObject,
     DBusErrorNoSession,
 )
+from pass_secret_service.common.metrics import metrics, timed_methods
 from pass_secret_service.common.names import base_path, COLLECTION_LABEL
-from pass_secret_service.common.tools import run_in_executor
+from pass_secret_service.common.reencrypt import Reencryption
+from pass_secret_service.common.tools import (
+    current_message,
+    emit_batched,
+    executor_sizes,
+    executor_stats,
+    gather_bounded,
+    run_in_executor,
+    SingleFlight,
+    WriteBehind,
+)
+from pass_secret_service.common.watcher import Watcher
 from pass_secret_service.interfaces.collection import Collection
-from pass_secret_service.interfaces.session import Session
+from pass_secret_service.interfaces.metrics import MetricsInterface
+from pass_secret_service.interfaces.session import DHKeyPool, Session
+from pass_secret_service.interfaces.store import StoreInterface
+
 
+logger = logging.getLogger(__name__)
 
+
+@timed_methods("org.freedesktop.Secret.Service")
 class Service(ServiceInterface):
 
     # finder
@@ -44,20 +69,43 @@ class Service(ServiceInterface):
             raise DBusErrorNoSuchObject(collection_path)
         return collection
 
-    def _get_item_from_path(self, item_path):
-        if item_path == "/":
-            return None
+    def _split_item_path(self, item_path):
         path_components = self._get_relative_object_path(item_path).split("/")
         if len(path_components) != 3 or path_components[0] != "collection":
             raise DBusErrorNoSuchObject(item_path)
         collection = self.collections.get(path_components[1])
         if collection is None:
             raise DBusErrorNoSuchObject(item_path)
-        item = collection.items.get(path_components[2])
+        return collection, path_components[2]
+
+    def _get_item_from_path(self, item_path):
+        if item_path == "/":
+            return None
+        collection, item_id = self._split_item_path(item_path)
+        if collection.locked:
+            raise DBusErrorIsLocked(item_path)
+        item = collection.items.get(item_id)
         if item is None:
             raise DBusErrorNoSuchObject(item_path)
         return item
 
+    def _on_message(self, msg):
+        if msg.message_type == MessageType.METHOD_CALL:
+            current_message.set(msg)
+            # Items are exported lazily, right before the first call addressing them is dispatched
+            if msg.path.startswith(self.path + "/collection/"):
+                try:
+                    self._get_item_from_path(msg.path)._export()
+                except DBusErrorIsLocked:
+                    collection, item_id = self._split_item_path(msg.path)
+                    collection._export_locked_item(item_id)
+                except DBusErrorNoSuchObject:
+                    pass
+        elif msg.message_type == MessageType.SIGNAL and msg.member == "NameOwnerChanged" and msg.sender == "org.freedesktop.DBus":
+            name, old_owner, new_owner = msg.body
+            if not new_owner and name in self.peers:
+                asyncio.ensure_future(self._reap_peer(name))
+
     def _get_session_from_path(self, session_path):
         path_components = self._get_relative_object_path(session_path).split("/")
         if len(path_components) != 2 or path_components[0] != "session":
@@ -65,8 +113,69 @@ class Service(ServiceInterface):
         session = self.sessions.get(path_components[1])
         if session is None:
             raise DBusErrorNoSession(session_path)
+        session.last_used = time.monotonic()
         return session
 
+    # Session tracking
+    async def _call_bus_daemon(self, member, signature, body):
+        reply = await self.bus.call(
+            Message(
+                destination="org.freedesktop.DBus",
+                path="/org/freedesktop/DBus",
+                interface="org.freedesktop.DBus",
+                member=member,
+                signature=signature,
+                body=body,
+            )
+        )
+        if reply.message_type == MessageType.ERROR:
+            raise DBusError._from_message(reply)
+        return reply.body
+
+    @staticmethod
+    def _peer_match_rule(sender):
+        return "type='signal',sender='org.freedesktop.DBus',interface='org.freedesktop.DBus',member='NameOwnerChanged',arg0='{}'".format(sender)
+
+    async def _track_session(self, session):
+        if session.sender is None:
+            return
+        sessions = self.peers.get(session.sender)
+        if sessions is not None:
+            sessions[session.id] = session
+            return
+        self.peers[session.sender] = {session.id: session}
+        # Get told when the client disconnects, and check it did not do so already
+        await self._call_bus_daemon("AddMatch", "s", [self._peer_match_rule(session.sender)])
+        [has_owner] = await self._call_bus_daemon("NameHasOwner", "s", [session.sender])
+        if not has_owner:
+            await self._reap_peer(session.sender)
+
+    def _untrack_session(self, session):
+        sessions = self.peers.get(session.sender)
+        if sessions is not None:
+            sessions.pop(session.id, None)
+            if not sessions:
+                self.peers.pop(session.sender)
+                asyncio.ensure_future(self._call_bus_daemon("RemoveMatch", "s", [self._peer_match_rule(session.sender)]))
+
+    async def _reap_peer(self, sender):
+        # Close all sessions of a client that left the bus
+        sessions = self.peers.get(sender, {})
+        logger.info("Closing %d session(s) of disconnected client %s", len(sessions), sender)
+        for session in list(sessions.values()):
+            await session._close()
+
+    def _schedule_session_reaper(self):
+        if self.session_timeout > 0:
+            self._session_reaper = asyncio.get_running_loop().call_later(self.session_timeout / 2, self._reap_idle_sessions)
+
+    def _reap_idle_sessions(self):
+        deadline = time.monotonic() - self.session_timeout
+        for session in [session for session in self.sessions.values() if session.last_used < deadline]:
+            asyncio.ensure_future(session._close())
+        self._schedule_session_reaper()
+        self.dh_pool.fill()
+
     # Alias helpers
     def _set_alias(self, alias, collection):
         changed = False
@@ -80,13 +189,14 @@ class Service(ServiceInterface):
         if collection:
             alias_path = base_path + "/aliases/" + alias
             self.bus.export(alias_path, collection)
+            self.bus.export(alias_path, collection.extension)
             self.aliases[alias] = {"collection": collection, "path": alias_path}
             changed = True
         return changed
 
-    @run_in_executor
     def _save_aliases(self):
-        self.pass_store.save_aliases({key: value["collection"].id for key, value in self.aliases.items()})
+        self.pass_store.queue_aliases({key: value["collection"].id for key, value in self.aliases.items()})
+        self.write_behind.schedule()
 
     async def _set_aliases(self, alias_dict):
         changed = False
@@ -94,7 +204,7 @@ class Service(ServiceInterface):
             if self._set_alias(alias, collection):
                 changed = True
         if changed:
-            await self._save_aliases()
+            self._save_aliases()
 
     # secret helper
     async def _encode_secret(self, session_path, password):
@@ -106,6 +216,18 @@ class Service(ServiceInterface):
         return await session._decode_secret(secret)
 
     async def _unregister(self):
+        # Write out all pending metadata
+        await self.write_behind.flush()
+        if self._purge is not None:
+            await self._purge
+        if self.watcher is not None:
+            self.watcher.stop()
+        self.bus.remove_message_handler(self._on_message)
+        if self._session_reaper is not None:
+            self._session_reaper.cancel()
+        self.dh_pool.close()
+        if self.secret_cache is not None:
+            self.secret_cache.clear()
         for session in self.sessions.values():
             await session._unregister()
         for alias in self.aliases.values():
@@ -114,14 +236,48 @@ class Service(ServiceInterface):
             await collection._unregister()
         self.bus.unexport(self.path)
 
-    def __init__(self, bus, pass_store):
+    def __init__(
+        self,
+        bus,
+        pass_store,
+        max_parallel_decrypts=8,
+        max_parallel_encrypts=8,
+        cache_ttl=0,
+        cache_size=128,
+        watch=False,
+        write_delay=0.2,
+        session_timeout=0,
+        dh_pool_size=8,
+        dh_pool_threshold=None,
+    ):
         super().__init__("org.freedesktop.Secret.Service")
         self.bus = bus
         self.pass_store = pass_store
+        self.max_parallel_decrypts = max_parallel_decrypts
+        self.max_parallel_encrypts = max_parallel_encrypts
+        self.secret_cache = SecretCache(cache_ttl, cache_size) if cache_ttl > 0 else None
+        self.decryptions = SingleFlight()
+        self.write_behind = WriteBehind(self.pass_store.flush, write_delay)
+        self.watcher = Watcher(self.pass_store.base_path, self._on_store_changed) if watch else None
+        if self.watcher is not None:
+            self.pass_store.track_writes()
+        self.resync_lock = asyncio.Lock()
+        # Aliases are only known once the store is loaded, see _load
+        self.loaded = asyncio.Event()
+        self._purge = None
+        self._purge_pending = False
         self.sessions = {}
+        # Sessions by the unique bus name of their client
+        self.peers = {}
+        self.session_timeout = session_timeout
+        self._session_reaper = None
+        self.dh_pool = DHKeyPool(dh_pool_size, dh_pool_threshold)
         self.collections = {}
         self.aliases = {}
         self.path = base_path
+        self.metrics_interface = MetricsInterface(self)
+        self.store_interface = StoreInterface(self)
+        self.reencryption = None
 
     @run_in_executor
     def _get_collections(self):
@@ -131,18 +287,151 @@ class Service(ServiceInterface):
     def _get_aliases(self):
         return self.pass_store.get_aliases()
 
-    @classmethod
-    async def _init(cls, bus, pass_store):
-        self = cls(bus, pass_store)
-        for collection_id in await self._get_collections():
-            await Collection._init(self, collection_id)
-        aliases = await self._get_aliases()
-        await self._set_aliases({alias: self.collections.get(collection_id) for alias, collection_id in aliases.items()})
-        # Create default collection if need be
-        if "default" not in self.aliases:
-            await self._create_collection({COLLECTION_LABEL: Variant("s", "default collection")}, "default")
+    @run_in_executor
+    def _changed_by_others(self, collection_id, names):
+        return self.pass_store.changed_by_others(collection_id, names)
+
+    @run_in_executor
+    def _save_manifest(self):
+        # The manifest only spares reading the store again, e.g. a read-only store works without it
+        try:
+            self.pass_store.save_manifest()
+        except OSError:
+            logger.warning("Failed to save the manifest", exc_info=True)
+
+    @run_in_executor
+    def _purge_from_store(self):
+        self.pass_store.purge_collections()
+
+    async def _run_purge(self):
+        while self._purge_pending:
+            self._purge_pending = False
+            try:
+                await self._purge_from_store()
+            except OSError:
+                logger.warning("Failed to purge deleted collections", exc_info=True)
+
+    def _purge_collections(self):
+        # Remove the files of deleted collections in the background
+        self._purge_pending = True
+        if self._purge is None or self._purge.done():
+            self._purge = asyncio.ensure_future(self._run_purge())
+
+    async def _load_collection(self, collection_id, aliases):
+        collection = await Collection._init(self, collection_id)
+        # Serve aliases as soon as their collection is available
+        for alias, alias_collection_id in aliases.items():
+            if alias_collection_id == collection_id:
+                self._set_alias(alias, collection)
+
+    async def _load(self):
+        if self.watcher is not None:
+            # Start watching before loading, so no change gets lost
+            self.watcher.start()
+        try:
+            async with self.resync_lock:
+                aliases = await self._get_aliases()
+                # Collections are loaded concurrently, each in a single executor task
+                await asyncio.gather(*(self._load_collection(collection_id, aliases) for collection_id in await self._get_collections()))
+                await self._save_manifest()
+            # Finish deletions interrupted by a crash
+            self._purge_collections()
+            # Create default collection if need be
+            if "default" not in self.aliases:
+                await self._create_collection({COLLECTION_LABEL: Variant("s", "default collection")}, "default")
+        finally:
+            self.loaded.set()
+
+    def _on_store_changed(self, changes):
+        asyncio.ensure_future(self._resync(changes))
+
+    async def _resync(self, changes=None):
+        # Apply changes made to the store by others; `None` checks every collection
+        async with self.resync_lock:
+            collection_ids = set(await self._get_collections())
+            if changes is None:
+                changes = dict.fromkeys(collection_ids | set(self.collections))
+            reloaded = False
+            for collection_id, names in changes.items():
+                collection = self.collections.get(collection_id)
+                try:
+                    if names and collection is not None and collection_id in collection_ids:
+                        # The watcher also sees the writes of this service
+                        names = await self._changed_by_others(collection_id, names)
+                        if not names:
+                            continue
+                    else:
+                        reloaded = True
+                    if collection_id not in collection_ids:
+                        if collection is not None:
+                            async with collection.rwlock.write():
+                                if self.collections.get(collection_id) is collection:
+                                    await emit_batched(self.bus, collection.ItemDeleted, collection._detach_items())
+                                    await collection._detach()
+                                    self.CollectionDeleted(collection)
+                    elif collection is None:
+                        self.CollectionCreated(await Collection._init(self, collection_id))
+                    else:
+                        await collection._resync(names)
+                except OSError:
+                    logger.warning("Failed to resync collection %s", collection_id, exc_info=True)
+            if reloaded:
+                await self._save_manifest()
+
+    async def _reencrypt(self, collection_paths, workers):
+        if self.reencryption is not None:
+            raise DBusErrorFailed("A re-encryption is already running.")
+        collection_ids = [self._get_collection_from_path(collection_path).id for collection_path in collection_paths]
+        self.reencryption = Reencryption(self.pass_store, collection_ids, workers or executor_sizes["gpg"])
+        try:
+            return await self.reencryption.run()
+        finally:
+            self.reencryption = None
+
+    def _stats(self):
+        items = [item for collection in self.collections.values() for item in collection.items.values()]
+        exported_items = sum(1 for item in items if item.interface is not None)
+        cache = self.secret_cache
+        lookups = cache.hits + cache.misses if cache else 0
+        return {
+            "uptime_s": time.monotonic() - metrics.started,
+            "latency": metrics.snapshot(),
+            "executors": executor_stats(),
+            "objects": {
+                "sessions": len(self.sessions),
+                "peers": len(self.peers),
+                "collections": len(self.collections),
+                "aliases": len(self.aliases),
+                "items": len(items),
+                "exported_items": exported_items,
+                "exported_paths": 1 + len(self.sessions) + len(self.collections) + len(self.aliases) + exported_items,
+            },
+            "cache": {
+                "enabled": cache is not None,
+                "entries": len(cache) if cache else 0,
+                "hits": cache.hits if cache else 0,
+                "misses": cache.misses if cache else 0,
+                "hit_rate": cache.hits / lookups if lookups else 0.0,
+            },
+            "decryptions": {"calls": self.decryptions.calls, "shared": self.decryptions.shared},
+            "dh_pool": {"size": self.dh_pool.size, "available": len(self.dh_pool)},
+            "reencryption": self.reencryption.progress() if self.reencryption else None,
+        }
+
+    def _register(self):
         # Register with dbus
+        self.bus.add_message_handler(self._on_message)
         self.bus.export(self.path, self)
+        self.bus.export(self.path, self.metrics_interface)
+        self.bus.export(self.path, self.store_interface)
+        self._schedule_session_reaper()
+        self.dh_pool.fill()
+
+    @classmethod
+    async def _init(cls, bus, pass_store, **kwargs):
+        self = cls(bus, pass_store, **kwargs)
+        await self._load()
+        self._register()
         return self
 
     @method()
@@ -151,10 +440,12 @@ class Service(ServiceInterface):
             aes_key = None
             output = Variant("s", "")
         elif algorithm == "dh-ietf1024-sha256-aes128-cbc-pkcs7":
-            aes_key, output = await Session._create_dh(input.value)
+            aes_key, output = await Session._create_dh(input.value, self.dh_pool.get())
+            self.dh_pool.fill()
         else:
             raise DBusErrorNotSupported('algorithm "{}" is not implemented'.format(algorithm))
         new_session = Session(self, aes_key=aes_key)
+        await self._track_session(new_session)
         result = new_session.path
         return [output, result]
 
@@ -166,19 +457,20 @@ class Service(ServiceInterface):
 
     @method()
     async def CreateCollection(self, properties: "a{sv}", alias: "s") -> "oo":
+        if alias != "":
+            # With an early bus name, an alias taken before loading would be overridden by the stored one
+            await self.loaded.wait()
         collection = await self._create_collection(properties, alias)
         prompt = "/"
         return [collection.path, prompt]
 
     @method()
     async def SearchItems(self, attributes: "a{ss}") -> "aoao":
+        # Locked collections hold no items in memory, they keep an index of item paths for searching
         unlocked = []
         locked = []
         for collection in self.collections.values():
-            if collection.locked:
-                locked.extend(collection._search_items(attributes))
-            else:
-                unlocked.extend(collection._search_items(attributes))
+            (locked if collection.locked else unlocked).extend(collection._search_items(attributes))
         return [unlocked, locked]
 
     @method()
@@ -188,15 +480,15 @@ class Service(ServiceInterface):
             try:
                 collection = self._get_collection_from_path(obj_path)
                 if collection:
-                    collection._unlock()
+                    await collection._unlock()
                     unlocked.append(obj_path)
                     continue
             except DBusErrorNoSuchObject:
                 pass
             try:
-                item = self._get_item_from_path(obj_path)
-                if item:
-                    item.collection._unlock()
+                collection, item_id = self._split_item_path(obj_path)
+                await collection._unlock()
+                if item_id in collection.items:
                     unlocked.append(obj_path)
                     continue
             except DBusErrorNoSuchObject:
@@ -211,7 +503,7 @@ class Service(ServiceInterface):
             try:
                 collection = self._get_collection_from_path(obj_path)
                 if collection:
-                    collection._lock()
+                    await collection._lock()
                     locked.append(obj_path)
                     continue
             except DBusErrorNoSuchObject:
@@ -221,21 +513,20 @@ class Service(ServiceInterface):
 
     @method()
     async def GetSecrets(self, items: "ao", session: "o") -> "a{o(oayays)}":
-        secrets = {}
         session = self._get_session_from_path(session)
-        for item_path in items:
-            item = self._get_item_from_path(item_path)
-            password = await item._get_password()
-            secrets[item_path] = await session._encode_secret(password)
-        return secrets
+        item_objects = [self._get_item_from_path(item_path) for item_path in items]
+        passwords = await gather_bounded(self.max_parallel_decrypts, (item._read_password() for item in item_objects))
+        return dict(zip(items, await session._encode_secrets(passwords)))
 
     @method()
     async def ReadAlias(self, name: "s") -> "o":
+        await self.loaded.wait()
         alias = self.aliases.get(name)
         return alias["collection"].path if alias else "/"
 
     @method()
     async def SetAlias(self, name: "s", collection: "o") -> "":
+        await self.loaded.wait()
         await self._set_aliases({name: self._get_collection_from_path(collection)})
 
     @signal()
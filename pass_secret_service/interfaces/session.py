@@ -1,8 +1,10 @@
 # Implementation of the org.freedesktop.Secret.Session interface
-# TODO unregister when client disconnects from dbus
 
+import asyncio
 import os
 import hmac
+import time
+from collections import deque
 from hashlib import sha256
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.ciphers import Cipher
@@ -17,17 +19,62 @@ from dbus_next.service import (
 
 from dbus_next import Variant
 
+from pass_secret_service.common.metrics import timed_methods
 from pass_secret_service.common.names import base_path
-from pass_secret_service.common.tools import run_in_executor, SerialMixin
+from pass_secret_service.common.tools import current_message, get_executor, run_in_executor, SerialMixin
 from pass_secret_service.common.consts import dh_prime
 
+# Secrets up to this many bytes are encrypted and decrypted on the event loop
+INLINE_LIMIT = 4096
 
+
+def generate_dh_keypair():
+    priv_key = int.from_bytes(os.urandom(0x80), "big")
+    return priv_key, pow(2, priv_key, dh_prime)
+
+
+class DHKeyPool:
+    # Keypairs generated ahead of time in the background, so OpenSession only computes the shared secret.
+    # Every keypair is handed out exactly once.
+
+    def __init__(self, size=0, threshold=None):
+        self.size = size
+        self.threshold = size // 2 if threshold is None else threshold
+        self._keypairs = deque()
+        self._refill_task = None
+
+    def __len__(self):
+        return len(self._keypairs)
+
+    async def _refill(self):
+        try:
+            while len(self._keypairs) < self.size:
+                # One keypair per job, so the event loop gets the GIL back in between
+                self._keypairs.append(await asyncio.get_running_loop().run_in_executor(get_executor("crypto"), generate_dh_keypair))
+        finally:
+            self._refill_task = None
+
+    def fill(self):
+        if self.size > 0 and self._refill_task is None and len(self._keypairs) <= self.threshold:
+            self._refill_task = asyncio.ensure_future(self._refill())
+
+    def get(self):
+        # Returns None when the pool ran dry.
+        # Call fill() once the handshake is done; refilling right away would compete with it for the GIL.
+        return self._keypairs.popleft() if self._keypairs else None
+
+    def close(self):
+        if self._refill_task is not None:
+            self._refill_task.cancel()
+        self._keypairs.clear()
+
+
+@timed_methods("org.freedesktop.Secret.Session")
 class Session(ServiceInterface, SerialMixin):
     @classmethod
-    @run_in_executor
-    def _create_dh(cls, input):
-        priv_key = int.from_bytes(os.urandom(0x80), "big")
-        pub_key = pow(2, priv_key, dh_prime)
+    @run_in_executor(pool="crypto")
+    def _create_dh(cls, input, keypair=None):
+        priv_key, pub_key = keypair or generate_dh_keypair()
         shared_secret = pow(int.from_bytes(input, "big"), priv_key, dh_prime)
         salt = b"\x00" * 0x20
         shared_key = hmac.new(salt, shared_secret.to_bytes(0x80, "big"), sha256).digest()
@@ -35,39 +82,75 @@ class Session(ServiceInterface, SerialMixin):
         return aes_key, Variant("ay", pub_key.to_bytes(0x80, "big"))
 
     # secrethelper
-    @run_in_executor
-    def _encode_secret(self, password):
+    def _encrypt(self, password):
         aes_iv = b""
         password = password.encode("utf8")
         if self.aes_key:
             aes_iv = os.urandom(0x10)
-            padder = PKCS7(0x80).padder()
+            padder = self._padding.padder()
             password = padder.update(password) + padder.finalize()
-            encryptor = Cipher(AES(self.aes_key), CBC(aes_iv), default_backend()).encryptor()
+            encryptor = Cipher(self._algorithm, CBC(aes_iv), self._backend).encryptor()
             password = encryptor.update(password) + encryptor.finalize()
         return [self.path, aes_iv, password, "text/plain"]
 
-    @run_in_executor
-    def _decode_secret(self, secret):
+    def _encrypt_all(self, passwords):
+        return [self._encrypt(password) for password in passwords]
+
+    def _decrypt(self, secret):
         password = secret[2]
         if self.aes_key:
             aes_iv = bytes(secret[1])
-            decryptor = Cipher(AES(self.aes_key), CBC(aes_iv), default_backend()).decryptor()
+            decryptor = Cipher(self._algorithm, CBC(aes_iv), self._backend).decryptor()
             password = decryptor.update(password) + decryptor.finalize()
-            unpadder = PKCS7(0x80).unpadder()
+            unpadder = self._padding.unpadder()
             password = unpadder.update(password) + unpadder.finalize()
         return bytearray(password).decode("utf8")
 
+    def _inline(self, size):
+        # Encrypting a few blocks is cheaper than the hop to the executor
+        return not self.aes_key or size <= INLINE_LIMIT
+
+    async def _encode_secret(self, password):
+        if self._inline(len(password)):
+            return self._encrypt(password)
+        return await asyncio.get_running_loop().run_in_executor(get_executor("crypto"), self._encrypt, password)
+
+    async def _encode_secrets(self, passwords):
+        if self._inline(sum(len(password) for password in passwords)):
+            return self._encrypt_all(passwords)
+        return await asyncio.get_running_loop().run_in_executor(get_executor("crypto"), self._encrypt_all, passwords)
+
+    async def _decode_secret(self, secret):
+        if self._inline(len(secret[2])):
+            return self._decrypt(secret)
+        return await asyncio.get_running_loop().run_in_executor(get_executor("crypto"), self._decrypt, secret)
+
     async def _unregister(self):
         self.bus.unexport(self.path)
 
+    async def _close(self):
+        # Deregister from service
+        self.service.sessions.pop(self.id, None)
+        self.service._untrack_session(self)
+        # Deregister from dbus
+        await self._unregister()
+
     def __init__(self, service, aes_key=None):
         super().__init__("org.freedesktop.Secret.Session")
         self.service = service
         self.aes_key = aes_key
+        if aes_key:
+            # Prepared once, only the IV changes per secret
+            self._algorithm = AES(aes_key)
+            self._padding = PKCS7(AES.block_size)
+            self._backend = default_backend()
         self.bus = self.service.bus
         self.id = "session{}".format(self._serial())
         self.path = "{}/session/{}".format(base_path, self.id)
+        # Unique bus name of the client that opened the session
+        msg = current_message.get()
+        self.sender = msg.sender if msg is not None else None
+        self.last_used = time.monotonic()
         # Register with dbus
         self.bus.export(self.path, self)
         # Register with service
@@ -75,7 +158,4 @@ class Session(ServiceInterface, SerialMixin):
 
     @method()
     async def Close(self) -> "":
-        # Deregister from service
-        self.service.sessions.pop(self.id)
-        # Deregister from dbus
-        await self._unregister()
+        await self._close()
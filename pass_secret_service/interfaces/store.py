@@ -0,0 +1,22 @@
+# Vendor interface for maintenance of the password store
+
+import json
+
+from dbus_next.service import (
+    method,
+    ServiceInterface,
+)
+
+from pass_secret_service.common.metrics import timed_methods
+from pass_secret_service.common.names import store_interface
+
+
+@timed_methods(store_interface)
+class StoreInterface(ServiceInterface):
+    def __init__(self, service):
+        super().__init__(store_interface)
+        self.service = service
+
+    @method()
+    async def Reencrypt(self, collections: "ao", workers: "u") -> "s":
+        return json.dumps(await self.service._reencrypt(collections, workers), sort_keys=True)
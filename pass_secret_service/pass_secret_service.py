@@ -3,13 +3,19 @@
 import asyncio
 import click
 import functools
+import json
 import logging
 import signal
 
+from dbus_next import Message, MessageType
 from dbus_next.aio import MessageBus
 
-from pass_secret_service.common.names import bus_name
+from pass_secret_service.common.names import base_path, bus_name, metrics_interface, store_interface
 from pass_secret_service.common.pass_store import PassStore
+from pass_secret_service.common.profiler import SamplingProfiler
+from pass_secret_service.common.reencrypt import Reencryption
+from pass_secret_service.common.tools import configure_executors, executor_sizes, executor_stats
+from pass_secret_service.common.trace import configure_tracing
 from pass_secret_service.interfaces.service import Service
 
 
@@ -21,39 +27,106 @@ def term_loop(loop):
     loop.stop()
 
 
-async def register_service(pass_store):
+async def register_service(pass_store, early_name=False, **kwargs):
     bus = await MessageBus().connect()
-    service = await Service._init(bus, pass_store)
-    reply = await bus.request_name(bus_name)
-    logger.info(repr(reply))
+    if early_name:
+        # Serve collections as they are loaded
+        service = Service(bus, pass_store, **kwargs)
+        service._register()
+        reply = await bus.request_name(bus_name)
+        logger.info(repr(reply))
+        await service._load()
+    else:
+        service = await Service._init(bus, pass_store, **kwargs)
+        reply = await bus.request_name(bus_name)
+        logger.info(repr(reply))
     # TODO check reply for PRIMARY_OWNER
     return service
 
 
-def _main(path, verbose):
+def _main(path, verbose, gpg_workers=4, crypto_workers=2, fs_workers=4, shard=False, trace=None, trace_format="jsonl", profile=None, **service_options):
     if verbose:
         logging.basicConfig(level=20)
-    pass_store = PassStore(**({"path": path} if path else {}))
+    configure_executors(gpg=gpg_workers or executor_sizes["gpg"], crypto=crypto_workers, fs=fs_workers)
+    configure_tracing(trace, trace_format)
+    pass_store = PassStore(pypass_decrypt=not gpg_workers, shard=shard, **({"path": path} if path else {}))
     mainloop = asyncio.get_event_loop()
     mainloop.add_signal_handler(signal.SIGTERM, functools.partial(term_loop, mainloop))
     mainloop.add_signal_handler(signal.SIGINT, functools.partial(term_loop, mainloop))
+    if profile:
+        # `kill -USR1` starts a CPU profile, a second one ends it early
+        mainloop.add_signal_handler(signal.SIGUSR1, SamplingProfiler(profile).trigger)
     try:
         logger.info("Register Service")
-        service = mainloop.run_until_complete(register_service(pass_store))
+        service = mainloop.run_until_complete(register_service(pass_store, **service_options))
         logger.info("Running main loop")
         mainloop.run_forever()
     finally:
-        mainloop.stop()
         mainloop.run_until_complete(service._unregister())
+        logger.info("Executors: %r", executor_stats())
+        configure_tracing(None)
         mainloop.run_until_complete(mainloop.shutdown_asyncgens())
         mainloop.close()
 
 
-@click.command()
+async def call_service(interface, member, signature="", body=()):
+    # Calls a vendor method of the running service, which all return JSON
+    bus = await MessageBus().connect()
+    try:
+        message = Message(destination=bus_name, path=base_path, interface=interface, member=member, signature=signature, body=list(body))
+        reply = await bus.call(message)
+    finally:
+        bus.disconnect()
+    if reply.message_type == MessageType.ERROR:
+        raise click.ClickException("{}: {}".format(reply.error_name, reply.body[0] if reply.body else ""))
+    return json.loads(reply.body[0])
+
+
+@click.group(invoke_without_command=True)
+@click.pass_context
 @click.option("--path", help="path to the password store (optional)")
 @click.option("-v", "--verbose", help="be verbose", is_flag=True, default=False)
-def main(path, verbose):
-    _main(path, verbose)
+@click.option("--gpg-workers", help="number of threads running gpg (0 forks through pypass instead)", type=int, default=4, show_default=True)
+@click.option("--crypto-workers", help="number of threads for Diffie-Hellman and AES", type=int, default=2, show_default=True)
+@click.option("--fs-workers", help="number of threads reading and writing the store metadata", type=int, default=4, show_default=True)
+@click.option("--max-parallel-decrypts", help="maximum number of concurrent decryptions per GetSecrets call", type=int, default=8, show_default=True)
+@click.option("--max-parallel-encrypts", help="maximum number of concurrent encryptions per CreateItems call", type=int, default=8, show_default=True)
+@click.option("--cache-ttl", help="keep decrypted secrets in memory for this many seconds (0 disables the cache)", type=float, default=0, show_default=True)
+@click.option("--cache-size", help="maximum number of decrypted secrets kept in memory", type=int, default=128, show_default=True)
+@click.option("--early-name", help="claim the bus name before all collections are loaded", is_flag=True, default=False)
+@click.option("--shard", help="keep the items of each collection in subdirectories, migrating flat collections on load", is_flag=True, default=False)
+@click.option("--watch", help="pick up changes made to the password store while running", is_flag=True, default=False)
+@click.option("--session-timeout", help="close sessions unused for this many seconds (0 disables the timeout)", type=float, default=0, show_default=True)
+@click.option("--dh-pool-size", help="number of Diffie-Hellman keypairs to generate ahead of time", type=int, default=8, show_default=True)
+@click.option("--dh-pool-threshold", help="refill the keypair pool when it holds this many or fewer [default: half the size]", type=int)
+@click.option("--trace", help="write a span for every D-Bus call to this file (rotated at 10MiB)", type=click.Path(dir_okay=False))
+@click.option("--trace-format", help="format of the trace file", type=click.Choice(["jsonl", "chrome"]), default="jsonl", show_default=True)
+@click.option("--profile", help="write a sampling CPU profile to this directory on SIGUSR1", type=click.Path(file_okay=False, exists=True))
+def main(ctx, path, verbose, **service_options):
+    if ctx.invoked_subcommand is None:
+        _main(path, verbose, **service_options)
+
+
+@main.command(help="print the metrics of the running service as JSON")
+def stats():
+    click.echo(json.dumps(asyncio.run(call_service(metrics_interface, "GetStats")), indent=2, sort_keys=True))
+
+
+@main.command(help="re-encrypt all secrets for the recipients in the .gpg-id files")
+@click.pass_context
+@click.option("--collection", "collections", help="id of a collection to re-encrypt [default: all]", multiple=True)
+@click.option("--workers", help="number of gpg processes to run in parallel", type=int, default=4, show_default=True)
+@click.option("--offline", help="work on the store directly instead of through the running service", is_flag=True, default=False)
+def reencrypt(ctx, collections, workers, offline):
+    logging.basicConfig(level=20)
+    if offline:
+        path = ctx.parent.params["path"]
+        pass_store = PassStore(**({"path": path} if path else {}))
+        report = asyncio.run(Reencryption(pass_store, list(collections), workers).run())
+    else:
+        collection_paths = [base_path + "/collection/" + collection for collection in collections]
+        report = asyncio.run(call_service(store_interface, "Reencrypt", "aou", [collection_paths, workers]))
+    click.echo(json.dumps(report, indent=2, sort_keys=True))
 
 
 if __name__ == "__main__":  # pragma: no cover
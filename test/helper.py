@@ -35,14 +35,16 @@ async def get_session(bus, path):
 
 
 class ServiceEnv:
-    def __init__(self, clean=True):
+    def __init__(self, clean=True, shard=False, **service_options):
         self.path = os.environ["PASSWORD_STORE_DIR"]
+        self.shard = shard
+        self.service_options = service_options
         if clean and os.path.exists(os.path.join(self.path, "secret_service")):
             shutil.rmtree(os.path.join(self.path, "secret_service"))
 
     async def __aenter__(self):
         self.bus = await MessageBus().connect()
-        self.service = await Service._init(self.bus, PassStore(path=self.path))
+        self.service = await Service._init(self.bus, PassStore(path=self.path, shard=self.shard), **self.service_options)
         await self.bus.request_name(bus_name)
         return self
 
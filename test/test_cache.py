@@ -0,0 +1,44 @@
+import pytest
+
+from pass_secret_service.common.cache import SecretCache
+
+
+class TestSecretCache:
+    @pytest.mark.asyncio
+    async def test_get_put_evict(self):
+        cache = SecretCache(60, max_entries=2)
+        cache.put(("c1", "i1"), "secret1", cache.generation)
+        assert cache.get(("c1", "i1")) == "secret1"
+        buffer = cache._entries[("c1", "i1")][1]
+        cache.evict(("c1", "i1"))
+        assert cache.get(("c1", "i1")) is None
+        assert buffer == bytearray(len("secret1"))
+        cache.clear()
+
+    @pytest.mark.asyncio
+    async def test_lru_and_collection(self):
+        cache = SecretCache(60, max_entries=2)
+        cache.put(("c1", "i1"), "secret1", cache.generation)
+        cache.put(("c2", "i2"), "secret2", cache.generation)
+        cache.get(("c1", "i1"))
+        cache.put(("c1", "i3"), "secret3", cache.generation)
+        assert cache.get(("c2", "i2")) is None
+        assert len(cache) == 2
+        cache.evict_collection("c1")
+        assert len(cache) == 0
+        cache.clear()
+
+    @pytest.mark.asyncio
+    async def test_stale_generation(self):
+        cache = SecretCache(60)
+        generation = cache.generation
+        cache.evict(("c1", "i1"))
+        cache.put(("c1", "i1"), "secret1", generation)
+        assert cache.get(("c1", "i1")) is None
+
+    @pytest.mark.asyncio
+    async def test_ttl(self):
+        cache = SecretCache(0)
+        cache.put(("c1", "i1"), "secret1", cache.generation)
+        assert cache.get(("c1", "i1")) is None
+        cache.clear()
@@ -1,11 +1,13 @@
 import asyncio
+import os
 import pytest
 
 from dbus_next import DBusError, Variant
 from dbus_next.aio import MessageBus
 
-from pass_secret_service.common.names import bus_name, base_path
-from .helper import get_collection, get_service, ServiceEnv
+from pass_secret_service.common.names import bus_name, base_path, collection_interface, ITEM_ATTRIBUTES, ITEM_LABEL
+from pass_secret_service.common.pass_store import PassStore
+from .helper import get_collection, get_item, get_service, ServiceEnv
 
 
 class TestCollection:
@@ -40,6 +42,41 @@ class TestCollection:
         await service.call_unlock([collection_path])
         assert await collection.get_locked() is False
 
+    @pytest.mark.asyncio
+    async def test_lock_evicts_items(self, bus):
+        async with ServiceEnv() as env:
+            service = await get_service(bus)
+            dummy, session_path = await service.call_open_session("plain", Variant("s", ""))
+            collection_path, prompt_path = await service.call_create_collection({}, "")
+            collection = await get_collection(bus, collection_path)
+            properties = {ITEM_ATTRIBUTES: Variant("a{ss}", {"attr": "value"})}
+            item_path, prompt_path = await collection.call_create_item(properties, [session_path, b"", b"password", "text/plain"], False)
+            await service.call_lock([collection_path])
+            assert env.service.collections[collection_path.rsplit("/", 1)[1]].items == {}
+            assert await collection.get_items() == [item_path]
+            # Answered from memory, not from the manifest
+            os.remove(os.path.join(env.service.pass_store.base_path, PassStore.MANIFEST))
+            assert await service.call_search_items({"attr": "value"}) == [[], [item_path]]
+            assert await collection.call_search_items({"attr": "other"}) == []
+            with pytest.raises(DBusError, match=r".*Object is locked:.*"):
+                await service.call_get_secrets([item_path], session_path)
+            with pytest.raises(DBusError, match=r".*Object is locked:.*"):
+                await collection.call_create_item({}, [session_path, b"", b"password", "text/plain"], False)
+            # Items of a locked collection answer with their metadata only
+            item = await get_item(bus, item_path)
+            assert await item.get_locked() is True
+            assert await item.get_attributes() == {"attr": "value"}
+            with pytest.raises(DBusError, match=r".*Object is locked:.*"):
+                await item.call_get_secret(session_path)
+            with pytest.raises(DBusError, match=r".*Object is locked:.*"):
+                await item.set_label("other")
+            # Unlocking through an item loads the collection again
+            assert await service.call_unlock([item_path]) == [[item_path], "/"]
+            assert await item.get_locked() is False
+            assert await service.call_search_items({"attr": "value"}) == [[item_path], []]
+            secrets = await service.call_get_secrets([item_path], session_path)
+            assert secrets[item_path][2] == b"password"
+
     @pytest.mark.asyncio
     async def test_persisted_item(self, bus):
         async with ServiceEnv():
@@ -51,3 +88,221 @@ class TestCollection:
             service = await get_service(bus)
             default_collection = await get_collection(bus, "/org/freedesktop/secrets/aliases/default")
             assert len(await default_collection.get_items()) == 1
+
+    @pytest.mark.asyncio
+    async def test_watch_store(self, bus):
+        async with ServiceEnv(watch=True) as env:
+            default_collection = await get_collection(bus, "/org/freedesktop/secrets/aliases/default")
+            collection_id = env.service.aliases["default"]["collection"].id
+            pass_store = PassStore(path=env.path)
+            item_id = pass_store.create_item(collection_id, "password", {ITEM_LABEL: "external"})
+            await asyncio.sleep(1)
+            item_path = "{}/collection/{}/{}".format(base_path, collection_id, item_id)
+            assert item_path in await default_collection.get_items()
+            assert item_path in (await (await get_service(bus)).call_search_items({}))[0]
+            pass_store.save_item_properties(collection_id, item_id, {ITEM_LABEL: "changed"})
+            await asyncio.sleep(1)
+            assert env.service._get_item_from_path(item_path).label == "changed"
+            pass_store.delete_item(collection_id, item_id)
+            new_collection_id = pass_store.create_collection({})
+            await asyncio.sleep(1)
+            assert item_path not in await default_collection.get_items()
+            assert "{}/collection/{}".format(base_path, new_collection_id) in await (await get_service(bus)).get_collections()
+            pass_store.delete_collection(new_collection_id)
+            await asyncio.sleep(1)
+            assert "{}/collection/{}".format(base_path, new_collection_id) not in await (await get_service(bus)).get_collections()
+
+    @pytest.mark.asyncio
+    async def test_watch_own_writes(self, bus):
+        async with ServiceEnv(watch=True) as env:
+            collection = env.service.aliases["default"]["collection"]
+            # Let the creation of the default collection pass
+            await asyncio.sleep(1)
+            resyncs = []
+            resync = collection._resync
+            collection._resync = lambda names=None: resyncs.append(names) or resync(names)
+            service = await get_service(bus)
+            dummy, session_path = await service.call_open_session("plain", Variant("s", ""))
+            default_collection = await get_collection(bus, "/org/freedesktop/secrets/aliases/default")
+            item_path, prompt_path = await default_collection.call_create_item({}, [session_path, b"", b"password", "text/plain"], False)
+            item = await get_item(bus, item_path)
+            await item.set_label("own")
+            await item.call_set_secret([session_path, b"", b"new", "text/plain"])
+            await asyncio.sleep(1)
+            assert resyncs == []
+            # Changes by others only read the changed item again
+            item_id = item_path.rsplit("/", 1)[1]
+            PassStore(path=env.path).save_item_properties(collection.id, item_id, {ITEM_LABEL: "external"})
+            await asyncio.sleep(1)
+            assert resyncs == [{item_id + ".properties"}]
+            assert collection.items[item_id].label == "external"
+
+    @pytest.mark.asyncio
+    async def test_watch_many_changes(self, bus):
+        async with ServiceEnv(watch=True) as env:
+            default_collection = await get_collection(bus, "/org/freedesktop/secrets/aliases/default")
+            collection_id = env.service.aliases["default"]["collection"].id
+            signals = {"created": [], "changed": [], "deleted": []}
+            default_collection.on_item_created(signals["created"].append)
+            default_collection.on_item_changed(signals["changed"].append)
+            default_collection.on_item_deleted(signals["deleted"].append)
+            pass_store = PassStore(path=env.path)
+            item_ids = ["external{}".format(i) for i in range(500)]
+            item_paths = ["{}/collection/{}/{}".format(base_path, collection_id, item_id) for item_id in item_ids]
+            # Written without encryption, only the metadata is read back
+            for item_id in item_ids:
+                with open(os.path.join(pass_store.base_path, collection_id, item_id + ".gpg"), "wb") as fp:
+                    fp.write(b"dummy")
+                pass_store.save_item_properties(collection_id, item_id, {ITEM_LABEL: "external"})
+            await asyncio.sleep(2)
+            # Unpaced signals would have cost the service its bus connection
+            assert env.service.bus.connected
+            assert sorted(await default_collection.get_items()) == sorted(item_paths)
+            for item_id in item_ids:
+                pass_store.save_item_properties(collection_id, item_id, {ITEM_LABEL: "changed"})
+            await asyncio.sleep(2)
+            for item_id in item_ids:
+                pass_store.delete_item(collection_id, item_id)
+            await asyncio.sleep(2)
+            assert env.service.bus.connected
+            assert await default_collection.get_items() == []
+            assert sorted(signals["created"]) == sorted(signals["changed"]) == sorted(signals["deleted"]) == sorted(item_paths)
+
+    @pytest.mark.asyncio
+    async def test_watch_sharded_store(self, bus):
+        async with ServiceEnv(watch=True, shard=True) as env:
+            default_collection = await get_collection(bus, "/org/freedesktop/secrets/aliases/default")
+            collection_id = env.service.aliases["default"]["collection"].id
+            pass_store = PassStore(path=env.path)
+            assert pass_store.is_sharded(collection_id)
+            item_ids = [pass_store.create_item(collection_id, "password", {ITEM_LABEL: "external"}) for i in range(3)]
+            await asyncio.sleep(1)
+            item_paths = ["{}/collection/{}/{}".format(base_path, collection_id, item_id) for item_id in item_ids]
+            assert sorted(await default_collection.get_items()) == sorted(item_paths)
+            pass_store.save_item_properties(collection_id, item_ids[0], {ITEM_LABEL: "changed"})
+            await asyncio.sleep(1)
+            assert env.service._get_item_from_path(item_paths[0]).label == "changed"
+
+    @pytest.mark.asyncio
+    async def test_create_items(self, bus):
+        async with ServiceEnv() as env:
+            service = await get_service(bus)
+            dummy, session_path = await service.call_open_session("plain", Variant("s", ""))
+            introspection = await bus.introspect(bus_name, base_path + "/aliases/default")
+            proxy = bus.get_proxy_object(bus_name, base_path + "/aliases/default", introspection)
+            default_collection = proxy.get_interface("org.freedesktop.Secret.Collection")
+            extension = proxy.get_interface(collection_interface)
+            created = []
+            changed = []
+            default_collection.on_item_created(created.append)
+            default_collection.on_item_changed(changed.append)
+
+            def entry(i, label):
+                properties = {ITEM_LABEL: Variant("s", label), ITEM_ATTRIBUTES: Variant("a{ss}", {"id": str(i)})}
+                return [properties, [session_path, b"", "password{}".format(i).encode(), "text/plain"]]
+
+            item_paths = await extension.call_create_items([entry(i, "item") for i in range(5)], False)
+            assert len(set(item_paths)) == 5
+            # Two replacements, one new item given twice
+            new_paths = await extension.call_create_items([entry(1, "new"), entry(3, "new"), entry(7, "first"), entry(7, "second")], True)
+            assert new_paths[:2] == [item_paths[1], item_paths[3]]
+            assert new_paths[2] == new_paths[3] not in item_paths
+            secrets = await service.call_get_secrets(item_paths + new_paths[2:3], session_path)
+            assert [secret[2] for secret in secrets.values()] == [b"password0", b"password1", b"password2", b"password3", b"password4", b"password7"]
+            item = env.service._get_item_from_path(new_paths[2])
+            assert item.label == "second"
+            assert env.service._get_item_from_path(item_paths[1]).label == "new"
+            await asyncio.sleep(0.1)
+            assert sorted(created) == sorted(item_paths + new_paths[2:3])
+            assert sorted(changed) == sorted([item_paths[1], item_paths[3]])
+        async with ServiceEnv(clean=False):
+            default_collection = await get_collection(bus, "/org/freedesktop/secrets/aliases/default")
+            assert sorted(await default_collection.get_items()) == sorted(item_paths + new_paths[2:3])
+
+    @pytest.mark.asyncio
+    async def test_delete_collection_items(self, bus):
+        async with ServiceEnv() as env:
+            service = await get_service(bus)
+            dummy, session_path = await service.call_open_session("plain", Variant("s", ""))
+            collection_path, prompt_path = await service.call_create_collection({}, "")
+            introspection = await bus.introspect(bus_name, collection_path)
+            proxy = bus.get_proxy_object(bus_name, collection_path, introspection)
+            collection = proxy.get_interface("org.freedesktop.Secret.Collection")
+            extension = proxy.get_interface(collection_interface)
+            entries = [[{ITEM_ATTRIBUTES: Variant("a{ss}", {"id": str(i)})}, [session_path, b"", b"password", "text/plain"]] for i in range(300)]
+            item_paths = await extension.call_create_items(entries, False)
+            deleted = []
+            collection.on_item_deleted(deleted.append)
+            await collection.call_delete()
+            await asyncio.sleep(0.1)
+            assert sorted(deleted) == sorted(item_paths)
+            assert collection_path not in await service.get_collections()
+            assert (await service.call_search_items({"id": "1"}))[0] == []
+        # The files were purged before the service exited
+        collection_id = collection_path.rsplit("/", 1)[1]
+        assert [name for name in os.listdir(env.service.pass_store.base_path) if name.endswith(collection_id)] == []
+
+    @pytest.mark.asyncio
+    async def test_concurrent_clients(self, bus):
+        async with ServiceEnv() as env:
+            service = await get_service(bus)
+            collection_path, prompt_path = await service.call_create_collection({}, "")
+            dummy, session_path = await service.call_open_session("plain", Variant("s", ""))
+            collection = await get_collection(bus, collection_path)
+            victim_path, prompt_path = await collection.call_create_item({}, [session_path, b"", b"victim", "text/plain"], False)
+            clients = 12
+            rounds = 12
+            loop = asyncio.get_running_loop()
+            # (started, finished, method, error type or None) of every call on the victim
+            calls = []
+
+            async def client(number):
+                client_bus = await MessageBus().connect()
+                try:
+                    service = await get_service(client_bus)
+                    collection = await get_collection(client_bus, collection_path)
+                    victim = await get_item(client_bus, victim_path)
+                    dummy, session_path = await service.call_open_session("plain", Variant("s", ""))
+                    for round in range(rounds):
+                        secret = "{}-{}".format(number, round).encode()
+                        properties = {ITEM_ATTRIBUTES: Variant("a{ss}", {"stress": "shared"})}
+                        item_path, prompt_path = await collection.call_create_item(properties, [session_path, b"", secret, "text/plain"], True)
+                        unlocked, locked = await service.call_search_items({"stress": "shared"})
+                        secrets = await service.call_get_secrets(unlocked, session_path)
+                        assert list(secrets) == [item_path]
+                        # One client deletes the victim halfway, while the others keep setting its secret
+                        method = "Delete" if (number, round) == (clients // 2, rounds // 2) else "SetSecret"
+                        started = loop.time()
+                        error = None
+                        try:
+                            if method == "Delete":
+                                await victim.call_delete()
+                            else:
+                                await victim.call_set_secret([session_path, b"", secret, "text/plain"])
+                        except DBusError as e:
+                            error = e.type
+                        calls.append((started, loop.time(), method, error))
+                finally:
+                    client_bus.disconnect()
+
+            await asyncio.gather(*(client(number) for number in range(clients)))
+            # Every client replaced the same item, the victim was deleted once and stayed deleted
+            unlocked, locked = await service.call_search_items({"stress": "shared"})
+            assert len(unlocked) == 1
+            assert await collection.get_items() == unlocked
+            collection_id = collection_path.rsplit("/", 1)[1]
+            assert list(env.service.pass_store.get_items(collection_id)) == [unlocked[0].rsplit("/", 1)[1]]
+            # Delete wins: calls overlapping it find the item gone, calls after it find no object at all
+            deletes = [call for call in calls if call[2] == "Delete" and call[3] is None]
+            assert len(deletes) == 1
+            delete_started, delete_finished = deletes[0][:2]
+            for started, finished, method, error in calls:
+                if error is None:
+                    assert started < delete_finished
+                elif error == "org.freedesktop.Secret.Error.NoSuchObject":
+                    assert finished > delete_started
+                else:
+                    assert error == "org.freedesktop.DBus.Error.UnknownMethod"
+                    assert finished > delete_started
+                if started > delete_finished:
+                    assert error == "org.freedesktop.DBus.Error.UnknownMethod"
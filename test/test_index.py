@@ -0,0 +1,28 @@
+from pass_secret_service.common.index import AttributeIndex
+
+
+class TestAttributeIndex:
+    def test_search(self):
+        index = AttributeIndex()
+        index.add("a", {"attr1": "1", "attr2": "2"})
+        index.add("b", {"attr1": "1"})
+        index.add("c", {"attr1": "0", "attr2": "2"})
+        assert index.search({}) == ["a", "b", "c"]
+        assert index.search({"attr1": "1"}) == ["a", "b"]
+        assert index.search({"attr1": "1", "attr2": "2"}) == ["a"]
+        assert index.search({"attr2": "2"}) == ["a", "c"]
+        assert index.search({"attr1": "2"}) == []
+        assert index.search({"attr3": "3"}) == []
+
+    def test_update_remove(self):
+        index = AttributeIndex()
+        index.add("a", {"attr1": "1"})
+        index.add("b", {"attr1": "1"})
+        index.add("a", {"attr1": "2"})
+        assert index.search({"attr1": "1"}) == ["b"]
+        assert index.search({"attr1": "2"}) == ["a"]
+        index.remove("a")
+        index.remove("a")
+        assert index.search({"attr1": "2"}) == []
+        assert index.search({}) == ["b"]
+        assert len(index) == 1
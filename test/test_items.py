@@ -1,10 +1,17 @@
+import errno
+import json
+import os
+import time
+
 import pytest
 
 from dbus_next import DBusError, Variant
+from dbus_next.errors import InterfaceNotFoundError
 
-from pass_secret_service.common.names import bus_name, base_path
+from pass_secret_service.common.names import bus_name, base_path, collection_interface, ITEM_CREATED, ITEM_LABEL
+from pass_secret_service.common.pass_store import PassStore
 
-from .helper import get_collection, get_item, get_service, get_session
+from .helper import get_collection, get_item, get_service, get_session, ServiceEnv
 
 
 class TestCollection:
@@ -59,8 +66,7 @@ class TestCollection:
         await item.set_attributes({"attr1": "val2"})
         assert await item.get_attributes() == {"attr1": "val2"}
         assert await item.get_locked() is False
-        assert await item.get_created() == 0
-        assert await item.get_modified() == 0
+        assert 0 < await item.get_created() <= await item.get_modified() <= time.time()
         await item.call_delete()
         await session.call_close()
 
@@ -127,3 +133,121 @@ class TestCollection:
         assert item1_path == item2_path
         assert item1_path != item3_path
         await session.call_close()
+
+    @pytest.mark.asyncio
+    async def test_cached_secret(self, bus):
+        async with ServiceEnv(cache_ttl=60) as env:
+            service = await get_service(bus)
+            default_collection = await get_collection(bus, "/org/freedesktop/secrets/aliases/default")
+            dummy, session_path = await service.call_open_session("plain", Variant("s", ""))
+            item_path, prompt_path = await default_collection.call_create_item({}, [session_path, b"", b"password", "text/plain"], False)
+            item = await get_item(bus, item_path)
+            assert [session_path, b"", b"password", "text/plain"] == await item.call_get_secret(session_path)
+            assert len(env.service.secret_cache) == 1
+            await item.call_set_secret([session_path, b"", b"secret", "text/plain"])
+            assert len(env.service.secret_cache) == 0
+            assert [session_path, b"", b"secret", "text/plain"] == await item.call_get_secret(session_path)
+            await service.call_lock([default_collection.path])
+            assert len(env.service.secret_cache) == 0
+
+    @pytest.mark.asyncio
+    async def test_lazy_export(self, bus):
+        async with ServiceEnv() as env:
+            service = await get_service(bus)
+            default_collection = await get_collection(bus, "/org/freedesktop/secrets/aliases/default")
+            dummy, session_path = await service.call_open_session("plain", Variant("s", ""))
+            item_path, prompt_path = await default_collection.call_create_item({}, [session_path, b"", b"password", "text/plain"], False)
+            assert env.service._get_item_from_path(item_path).interface is None
+            assert item_path in (await service.call_search_items({}))[0]
+            assert env.service._get_item_from_path(item_path).interface is None
+            item = await get_item(bus, item_path)
+            assert env.service._get_item_from_path(item_path).interface is not None
+            assert [session_path, b"", b"password", "text/plain"] == await item.call_get_secret(session_path)
+            with pytest.raises(InterfaceNotFoundError):
+                await get_item(bus, item_path + "tilt")
+
+    @pytest.mark.asyncio
+    async def test_persisted_properties(self, bus):
+        async with ServiceEnv():
+            service = await get_service(bus)
+            default_collection = await get_collection(bus, "/org/freedesktop/secrets/aliases/default")
+            dummy, session_path = await service.call_open_session("plain", Variant("s", ""))
+            item_path, prompt_path = await default_collection.call_create_item({}, [session_path, b"", b"password", "text/plain"], False)
+            item = await get_item(bus, item_path)
+            await item.set_label("label1")
+            await item.set_label("label2")
+            await item.set_attributes({"attr1": "val1"})
+        async with ServiceEnv(clean=False):
+            item = await get_item(bus, item_path)
+            assert await item.get_label() == "label2"
+            assert await item.get_attributes() == {"attr1": "val1"}
+
+    @pytest.mark.asyncio
+    async def test_interned_attributes(self, bus):
+        async with ServiceEnv() as env:
+            service = await get_service(bus)
+            default_collection = await get_collection(bus, "/org/freedesktop/secrets/aliases/default")
+            dummy, session_path = await service.call_open_session("plain", Variant("s", ""))
+            properties = {"org.freedesktop.Secret.Item.Attributes": Variant("a{ss}", {"xdg:schema": "org.example.Password"})}
+            items = []
+            for i in range(2):
+                item_path, prompt_path = await default_collection.call_create_item(properties, [session_path, b"", b"password", "text/plain"], False)
+                items.append(env.service._get_item_from_path(item_path))
+            item1, item2 = items
+            assert not hasattr(item1, "__dict__")
+            ((key1, value1),) = item1.attributes.items()
+            ((key2, value2),) = item2.attributes.items()
+            assert key1 is key2 and value1 is value2
+
+    @pytest.mark.asyncio
+    async def test_timestamps(self, bus):
+        async with ServiceEnv() as env:
+            collection_id = env.service.aliases["default"]["collection"].id
+        # An item written before timestamps were kept
+        pass_store = PassStore(path=env.path)
+        item_id = pass_store.create_item(collection_id, "password", {ITEM_LABEL: "old"})
+        item_file = os.path.join(pass_store.base_path, collection_id, item_id)
+        os.utime(item_file + ".gpg", (1000, 1000))
+        os.utime(item_file + ".properties", (2000, 2000))
+        async with ServiceEnv(clean=False):
+            service = await get_service(bus)
+            dummy, session_path = await service.call_open_session("plain", Variant("s", ""))
+            introspection = await bus.introspect(bus_name, base_path + "/aliases/default")
+            proxy = bus.get_proxy_object(bus_name, base_path + "/aliases/default", introspection)
+            default_collection = proxy.get_interface("org.freedesktop.Secret.Collection")
+            extension = proxy.get_interface(collection_interface)
+            old_path = "{}/collection/{}/{}".format(base_path, collection_id, item_id)
+            assert await extension.call_get_timestamps() == {old_path: [1000, 2000]}
+            with open(item_file + ".properties") as fp:
+                assert json.load(fp)[ITEM_CREATED] == 1000
+            start = int(time.time())
+            new_path, prompt_path = await default_collection.call_create_item({}, [session_path, b"", b"password", "text/plain"], False)
+            item = await get_item(bus, old_path)
+            await item.call_set_secret([session_path, b"", b"new", "text/plain"])
+            timestamps = await extension.call_get_timestamps()
+            assert timestamps[old_path][0] == 1000 and timestamps[old_path][1] >= start
+            assert timestamps[new_path][0] >= start
+            assert await default_collection.get_created() > 0
+
+    @pytest.mark.asyncio
+    async def test_timestamps_read_only_store(self, bus, monkeypatch):
+        async with ServiceEnv() as env:
+            collection_id = env.service.aliases["default"]["collection"].id
+        pass_store = PassStore(path=env.path)
+        item_id = pass_store.create_item(collection_id, "password", {ITEM_LABEL: "old"})
+        item_file = os.path.join(pass_store.base_path, collection_id, item_id)
+        os.utime(item_file + ".gpg", (1000, 1000))
+        os.utime(item_file + ".properties", (2000, 2000))
+
+        def read_only(self, path, text):
+            raise OSError(errno.EROFS, os.strerror(errno.EROFS), path)
+
+        monkeypatch.setattr(PassStore, "_write_file", read_only)
+        # Starting does not depend on writing the store, timestamps are kept in memory
+        async with ServiceEnv(clean=False):
+            introspection = await bus.introspect(bus_name, base_path + "/aliases/default")
+            extension = bus.get_proxy_object(bus_name, base_path + "/aliases/default", introspection).get_interface(collection_interface)
+            old_path = "{}/collection/{}/{}".format(base_path, collection_id, item_id)
+            assert await extension.call_get_timestamps() == {old_path: [1000, 2000]}
+        with open(item_file + ".properties") as fp:
+            assert ITEM_CREATED not in json.load(fp)
@@ -0,0 +1,210 @@
+import asyncio
+import json
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from pass_secret_service.common.names import ITEM_CREATED, ITEM_MODIFIED
+from pass_secret_service.common.pass_store import PassStore
+from pass_secret_service.common.reencrypt import JOURNAL, Reencryption
+
+
+@pytest.fixture
+def store_path(tmp_path):
+    with open(tmp_path / ".gpg-id", "w") as fp:
+        fp.write("8c2a59a7\n")
+    return str(tmp_path)
+
+
+def make_item(pass_store, collection_name, name, properties):
+    item_path = os.path.join(pass_store.base_path, collection_name, name)
+    with open(item_path + ".gpg", "wb") as fp:
+        fp.write(b"dummy")
+    pass_store.save_item_properties(collection_name, name, properties)
+    # Age the files beyond the racy window
+    os.utime(item_path + ".properties", ns=(10**18, 10**18))
+
+
+class TestPassStore:
+    def test_manifest(self, store_path):
+        pass_store = PassStore(path=store_path)
+        collection_name = pass_store.create_collection({})
+        make_item(pass_store, collection_name, "item1", {"label": "one"})
+        make_item(pass_store, collection_name, "item2", {"label": "two"})
+        assert pass_store.get_items_properties(collection_name) == {"item1": {"label": "one"}, "item2": {"label": "two"}}
+        pass_store.save_manifest()
+
+        pass_store = PassStore(path=store_path)
+        read_items = []
+        get_item_properties = pass_store.get_item_properties
+        pass_store.get_item_properties = lambda c, n: read_items.append(n) or get_item_properties(c, n)
+        assert pass_store.get_items_properties(collection_name) == {"item1": {"label": "one"}, "item2": {"label": "two"}}
+        assert read_items == []
+
+        item_path = os.path.join(pass_store.base_path, collection_name, "item2")
+        with open(item_path + ".properties", "w") as fp:
+            json.dump({"label": "changed"}, fp)
+        os.utime(item_path + ".properties", ns=(2 * 10**18, 2 * 10**18))
+        assert pass_store.get_items_properties(collection_name) == {"item1": {"label": "one"}, "item2": {"label": "changed"}}
+        assert read_items == ["item2"]
+
+    def test_manifest_pruned(self, store_path):
+        pass_store = PassStore(path=store_path)
+        collection_names = [pass_store.create_collection({}) for i in range(2)]
+        for collection_name in collection_names:
+            make_item(pass_store, collection_name, "item1", {"label": "one"})
+            pass_store.get_items_properties(collection_name)
+        pass_store.evict_collection(collection_names[1])
+        # Removed by another program
+        for collection_name in collection_names:
+            shutil.rmtree(os.path.join(pass_store.base_path, collection_name))
+        pass_store.save_manifest()
+        with open(os.path.join(pass_store.base_path, PassStore.MANIFEST)) as fp:
+            assert json.load(fp)["collections"] == {}
+
+    def test_manifest_concurrent_evict(self, store_path):
+        pass_store = PassStore(path=store_path)
+        collection_names = [pass_store.create_collection({}) for i in range(12)]
+        for collection_name in collection_names:
+            make_item(pass_store, collection_name, "item1", {"label": collection_name})
+            pass_store.get_items_properties(collection_name)
+        with ThreadPoolExecutor(max_workers=len(collection_names)) as executor:
+            list(executor.map(pass_store.evict_collection, collection_names))
+        pass_store.save_manifest()
+        assert [name for name in os.listdir(pass_store.base_path) if name.endswith(".tmp")] == []
+        with open(os.path.join(pass_store.base_path, PassStore.MANIFEST)) as fp:
+            assert set(json.load(fp)["collections"]) == set(collection_names)
+        for collection_name in collection_names:
+            assert pass_store.get_items_properties(collection_name) == {"item1": {"label": collection_name}}
+
+    def test_broken_manifest(self, store_path):
+        pass_store = PassStore(path=store_path)
+        collection_name = pass_store.create_collection({})
+        make_item(pass_store, collection_name, "item1", {"label": "one"})
+        with open(os.path.join(pass_store.base_path, PassStore.MANIFEST), "w") as fp:
+            fp.write("{broken")
+        pass_store = PassStore(path=store_path)
+        assert pass_store.get_items_properties(collection_name) == {"item1": {"label": "one"}}
+
+    def test_backfill_timestamps(self, store_path):
+        pass_store = PassStore(path=store_path)
+        collection_name = pass_store.create_collection({})
+        make_item(pass_store, collection_name, "item1", {"label": "one"})
+        os.utime(os.path.join(pass_store.base_path, collection_name, "item1.gpg"), (2 * 10**9, 2 * 10**9))
+        items_properties = pass_store.backfill_item_timestamps(collection_name, pass_store.get_items_properties(collection_name))
+        assert items_properties == {"item1": {"label": "one", ITEM_CREATED: 10**9, ITEM_MODIFIED: 2 * 10**9}}
+        pass_store.save_manifest()
+        # The rewritten files are not read again
+        pass_store = PassStore(path=store_path)
+        pass_store.RACY_WINDOW_NS = 0
+        read_items = []
+        get_item_properties = pass_store.get_item_properties
+        pass_store.get_item_properties = lambda c, n: read_items.append(n) or get_item_properties(c, n)
+        assert pass_store.get_items_properties(collection_name) == items_properties
+        assert read_items == []
+
+    def test_write_behind(self, store_path):
+        pass_store = PassStore(path=store_path)
+        collection_name = pass_store.create_collection({"label": "one"})
+        make_item(pass_store, collection_name, "item1", {"label": "one"})
+        pass_store.queue_item_properties(collection_name, "item1", {"label": "two"})
+        pass_store.queue_item_properties(collection_name, "item1", {"label": "three"})
+        pass_store.queue_collection_properties(collection_name, {"label": "three"})
+        assert pass_store.get_item_properties(collection_name, "item1") == {"label": "three"}
+        assert pass_store.get_items_properties(collection_name) == {"item1": {"label": "three"}}
+        with open(os.path.join(pass_store.base_path, collection_name, "item1.properties")) as fp:
+            assert json.load(fp) == {"label": "one"}
+        pass_store.flush()
+        assert PassStore(path=store_path).get_item_properties(collection_name, "item1") == {"label": "three"}
+        assert PassStore(path=store_path).get_collection_properties(collection_name) == {"label": "three"}
+        pass_store.queue_item_properties(collection_name, "item1", {"label": "four"})
+        pass_store.delete_item(collection_name, "item1")
+        pass_store.flush()
+        assert os.listdir(os.path.join(pass_store.base_path, collection_name)) == [".properties"]
+        # A failed write stays queued
+        pass_store.queue_collection_properties("missing", {"label": "five"})
+        with pytest.raises(OSError):
+            pass_store.flush()
+        assert pass_store.get_collection_properties("missing") == {"label": "five"}
+        os.mkdir(os.path.join(pass_store.base_path, "missing"))
+        pass_store.flush()
+        assert PassStore(path=store_path).get_collection_properties("missing") == {"label": "five"}
+
+    def test_delete_collection(self, store_path):
+        pass_store = PassStore(path=store_path)
+        collection_name = pass_store.create_collection({})
+        make_item(pass_store, collection_name, "item1", {"label": "one"})
+        pass_store.trash_collection(collection_name)
+        assert list(pass_store.get_collections()) == []
+        # Left over by a crash
+        assert PassStore(path=store_path).get_items_properties(PassStore.DELETING + collection_name) == {"item1": {"label": "one"}}
+        pass_store.purge_collections()
+        assert os.listdir(pass_store.base_path) == []
+
+    def test_sharded_layout(self, store_path):
+        pass_store = PassStore(path=store_path)
+        collection_name = pass_store.create_collection({})
+        make_item(pass_store, collection_name, "ab1", {"label": "one"})
+        make_item(pass_store, collection_name, "cd2", {"label": "two"})
+        collection_path = os.path.join(pass_store.base_path, collection_name)
+        # A migration interrupted after moving the first item
+        open(os.path.join(collection_path, PassStore.SHARDING), "w").close()
+        os.mkdir(os.path.join(collection_path, "ab"))
+        for suffix in (".gpg", ".properties"):
+            os.rename(os.path.join(collection_path, "ab1" + suffix), os.path.join(collection_path, "ab", "ab1" + suffix))
+        pass_store = PassStore(path=store_path)
+        assert pass_store.get_items_properties(collection_name) == {"ab1": {"label": "one"}, "cd2": {"label": "two"}}
+        assert pass_store.is_sharded(collection_name)
+        assert sorted(os.listdir(collection_path)) == [".properties", PassStore.SHARDED, "ab", "cd"]
+        assert sorted(os.listdir(os.path.join(collection_path, "cd"))) == ["cd2.gpg", "cd2.properties"]
+        pass_store.save_manifest()
+
+        pass_store = PassStore(path=store_path)
+        read_items = []
+        get_item_properties = pass_store.get_item_properties
+        pass_store.get_item_properties = lambda c, n: read_items.append(n) or get_item_properties(c, n)
+        assert pass_store.get_items_properties(collection_name) == {"ab1": {"label": "one"}, "cd2": {"label": "two"}}
+        assert read_items == []
+        pass_store.delete_item(collection_name, "ab1")
+        assert sorted(pass_store.get_items(collection_name)) == ["cd2"]
+
+        pass_store = PassStore(path=store_path, shard=True)
+        new_collection_name = pass_store.create_collection({})
+        names = pass_store.prepare_items(new_collection_name, [{"label": "three"}])
+        assert os.path.exists(os.path.join(pass_store.base_path, new_collection_name, names[0][:2], names[0] + ".properties"))
+
+    def test_reencrypt(self, store_path):
+        pass_store = PassStore(path=store_path)
+        collection_name = pass_store.create_collection({})
+        with open(os.path.join(pass_store.base_path, collection_name, ".gpg-id"), "w") as fp:
+            fp.write("# team key\n8c2a59a7\n")
+        assert pass_store.get_recipients(collection_name) == ["8c2a59a7"]
+        names = [pass_store.create_item(collection_name, "password{}".format(i), {}) for i in range(3)]
+        item_path = os.path.join(pass_store.base_path, collection_name, names[0]) + ".gpg"
+        with open(item_path, "rb") as fp:
+            ciphertext = fp.read()
+        report = asyncio.run(Reencryption(pass_store, workers=2).run())
+        assert (report["reencrypted"], report["skipped"], report["failed"]) == (3, 0, [])
+        with open(item_path, "rb") as fp:
+            assert fp.read() != ciphertext
+        assert [pass_store.get_item_password(collection_name, name) for name in names] == ["password0", "password1", "password2"]
+        assert not os.path.exists(os.path.join(pass_store.base_path, JOURNAL))
+        # Resume an interrupted run
+        with open(os.path.join(pass_store.base_path, JOURNAL), "w") as fp:
+            fp.write(json.dumps([collection_name, names[0], ["8c2a59a7"]]) + "\n")
+            fp.write('["torn')
+        report = asyncio.run(Reencryption(pass_store, [collection_name]).run())
+        assert (report["reencrypted"], report["skipped"]) == (2, 1)
+        # An item deleted while it is re-encrypted stays deleted
+        get_item_password = pass_store.get_item_password
+
+        def delete_while_decrypting(collection_name, name):
+            password = get_item_password(collection_name, name)
+            pass_store.delete_item(collection_name, name)
+            return password
+
+        pass_store.get_item_password = delete_while_decrypting
+        assert pass_store.reencrypt_item(collection_name, names[1], ["8c2a59a7"]) is False
+        assert sorted(pass_store.get_items(collection_name)) == sorted([names[0], names[2]])
@@ -1,15 +1,19 @@
 import asyncio
+import json
 import pytest
 import re
 
 from dbus_next import DBusError, Variant
 from dbus_next.aio import MessageBus
 
-from pass_secret_service.common.names import bus_name, base_path
+from pass_secret_service.common.names import bus_name, base_path, metrics_interface, store_interface
+from pass_secret_service.common.pass_store import PassStore
+from pass_secret_service.interfaces.service import Service
 
 from .helper import (
     get_collection,
     get_service,
+    ServiceEnv,
 )
 
 
@@ -89,3 +93,77 @@ class TestService:
             item_path, prompt_path = await collection.call_create_item({}, ["/", b"", b"password1", "text/plain"], False)
         with pytest.raises(DBusError):
             item_path, prompt_path = await collection.call_create_item({}, ["/org/freedesktop/secrets/nosession/test", b"", b"password1", "text/plain"], False)
+
+    @pytest.mark.asyncio
+    async def test_get_secrets_many(self, bus, pss_service):
+        service = await get_service(bus)
+        collection = await get_collection(bus, "/org/freedesktop/secrets/aliases/default")
+        prompt_path, session_path = await service.call_open_session("plain", Variant("s", ""))
+        item_paths = []
+        for i in range(10):
+            item_path, prompt_path = await collection.call_create_item({}, [session_path, b"", b"password%d" % i, "text/plain"], False)
+            item_paths.append(item_path)
+        secrets = await service.call_get_secrets(item_paths, session_path)
+        assert list(secrets) == item_paths
+        assert [secret[2] for secret in secrets.values()] == [b"password%d" % i for i in range(10)]
+        with pytest.raises(DBusError, match=r".*No such object:.*"):
+            await service.call_get_secrets(item_paths + [collection.path + "/tilt"], session_path)
+
+    @pytest.mark.asyncio
+    async def test_stats(self, bus, pss_service):
+        service = await get_service(bus)
+        prompt_path, session_path = await service.call_open_session("plain", Variant("s", ""))
+        with pytest.raises(DBusError):
+            await service.call_get_secrets(["/org/freedesktop/secrets/collection/tilt/tilt"], session_path)
+        introspection = await bus.introspect(bus_name, base_path)
+        metrics = bus.get_proxy_object(bus_name, base_path, introspection).get_interface(metrics_interface)
+        stats = json.loads(await metrics.call_get_stats())
+        open_session = stats["latency"]["org.freedesktop.Secret.Service.OpenSession"]
+        assert open_session["count"] >= 1
+        assert sum(count for bound, count in open_session["buckets"]) == open_session["count"]
+        assert stats["latency"]["org.freedesktop.Secret.Service.GetSecrets"]["errors"] >= 1
+        assert stats["objects"]["sessions"] >= 1
+        assert stats["objects"]["collections"] >= 1
+        assert set(stats["executors"]) <= {"crypto", "gpg", "fs"}
+
+    @pytest.mark.asyncio
+    async def test_reencrypt(self, bus, pss_service):
+        service = await get_service(bus)
+        prompt_path, session_path = await service.call_open_session("plain", Variant("s", ""))
+        collection = await get_collection(bus, "/org/freedesktop/secrets/aliases/default")
+        item_path, prompt_path = await collection.call_create_item({}, [session_path, b"", b"password", "text/plain"], False)
+        introspection = await bus.introspect(bus_name, base_path)
+        store = bus.get_proxy_object(bus_name, base_path, introspection).get_interface(store_interface)
+        report = json.loads(await store.call_reencrypt([collection.path], 2))
+        assert report["reencrypted"] >= 1 and report["failed"] == []
+        secrets = await service.call_get_secrets([item_path], session_path)
+        assert secrets[item_path][2] == b"password"
+        with pytest.raises(DBusError):
+            await store.call_reencrypt([collection.path + "tilt"], 0)
+
+    @pytest.mark.asyncio
+    async def test_early_name_aliases(self, bus):
+        async with ServiceEnv() as env:
+            default_path = env.service.aliases["default"]["collection"].path
+        # Register the name before loading, like --early-name does
+        service_bus = await MessageBus().connect()
+        service = Service(service_bus, PassStore(path=env.path))
+        service._register()
+        await service_bus.request_name(bus_name)
+        # Hold the loading back until the calls are in
+        await service.resync_lock.acquire()
+        load = asyncio.ensure_future(service._load())
+        try:
+            proxy = await get_service(bus)
+            read_alias = asyncio.ensure_future(proxy.call_read_alias("default"))
+            create_collection = asyncio.ensure_future(proxy.call_create_collection({}, "default"))
+            await asyncio.sleep(0.1)
+            service.resync_lock.release()
+            assert await read_alias == default_path
+            collection_path, prompt_path = await create_collection
+            await load
+            assert service.aliases["default"]["collection"].path == collection_path
+        finally:
+            await load
+            await service._unregister()
+            service_bus.disconnect()
@@ -1,10 +1,22 @@
 import asyncio
+import hmac
+import os
 import pytest
+from hashlib import sha256
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.ciphers import Cipher
+from cryptography.hazmat.primitives.ciphers.modes import CBC
+from cryptography.hazmat.primitives.ciphers.algorithms import AES
+from cryptography.hazmat.primitives.padding import PKCS7
 
 from dbus_next import DBusError, Variant
 from dbus_next.aio import MessageBus
 
-from .helper import get_service, get_session
+from pass_secret_service.common.consts import dh_prime
+from pass_secret_service.interfaces.session import DHKeyPool
+
+from .helper import get_collection, get_item, get_service, get_session, ServiceEnv
 
 
 class TestSession:
@@ -16,8 +28,74 @@ class TestSession:
         session = await get_session(bus, session_path)
         await session.call_close()
 
+    @pytest.mark.asyncio
+    async def test_session_dh(self, bus, pss_service):
+        service = await get_service(bus)
+        priv_key = int.from_bytes(os.urandom(0x80), "big")
+        pub_key = pow(2, priv_key, dh_prime)
+        output, session_path = await service.call_open_session("dh-ietf1024-sha256-aes128-cbc-pkcs7", Variant("ay", pub_key.to_bytes(0x80, "big")))
+        shared_secret = pow(int.from_bytes(output.value, "big"), priv_key, dh_prime)
+        shared_key = hmac.new(b"\x00" * 0x20, shared_secret.to_bytes(0x80, "big"), sha256).digest()
+        aes_key = hmac.new(shared_key, b"\x01", sha256).digest()[:0x10]
+        default_collection = await get_collection(bus, "/org/freedesktop/secrets/aliases/default")
+        # Small secrets are encrypted on the loop, large ones in the executor
+        for password in [b"password", b"x" * 10000]:
+            aes_iv = os.urandom(0x10)
+            padder = PKCS7(0x80).padder()
+            encryptor = Cipher(AES(aes_key), CBC(aes_iv), default_backend()).encryptor()
+            secret = encryptor.update(padder.update(password) + padder.finalize()) + encryptor.finalize()
+            item_path, prompt_path = await default_collection.call_create_item({}, [session_path, aes_iv, secret, "text/plain"], False)
+            item = await get_item(bus, item_path)
+            secrets = [await item.call_get_secret(session_path)] + list((await service.call_get_secrets([item_path], session_path)).values())
+            for dummy, aes_iv, secret, content_type in secrets:
+                decryptor = Cipher(AES(aes_key), CBC(aes_iv), default_backend()).decryptor()
+                unpadder = PKCS7(0x80).unpadder()
+                assert unpadder.update(decryptor.update(secret) + decryptor.finalize()) + unpadder.finalize() == password
+
+    @pytest.mark.asyncio
+    async def test_dh_key_pool(self):
+        pool = DHKeyPool(4, 1)
+        assert pool.get() is None
+        pool.fill()
+        for i in range(50):
+            if len(pool) == 4:
+                break
+            await asyncio.sleep(0.02)
+        keypairs = [pool.get() for i in range(4)]
+        assert None not in keypairs
+        assert len(set(keypairs)) == 4
+        pool.close()
+
     @pytest.mark.asyncio
     async def test_session_error(self, bus, pss_service):
         service = await get_service(bus)
         with pytest.raises(DBusError):
             output, session_path = await service.call_open_session("wrong plain", Variant("s", ""))
+
+    @pytest.mark.asyncio
+    async def test_session_reaped_on_disconnect(self, bus):
+        async with ServiceEnv() as env:
+            client_bus = await MessageBus().connect()
+            service = await get_service(client_bus)
+            output, session_path1 = await service.call_open_session("plain", Variant("s", ""))
+            output, session_path2 = await service.call_open_session("plain", Variant("s", ""))
+            assert len(env.service.sessions) == 2
+            assert list(env.service.peers) == [client_bus.unique_name]
+            client_bus.disconnect()
+            await client_bus.wait_for_disconnect()
+            for i in range(50):
+                if not env.service.sessions:
+                    break
+                await asyncio.sleep(0.02)
+            assert env.service.sessions == {}
+            assert env.service.peers == {}
+
+    @pytest.mark.asyncio
+    async def test_session_idle_timeout(self, bus):
+        async with ServiceEnv(session_timeout=0.2) as env:
+            service = await get_service(bus)
+            output, session_path = await service.call_open_session("plain", Variant("s", ""))
+            assert len(env.service.sessions) == 1
+            await asyncio.sleep(0.5)
+            assert env.service.sessions == {}
+            assert env.service.peers == {}
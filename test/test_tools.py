@@ -1,4 +1,8 @@
-from pass_secret_service.common.tools import SerialMixin
+import asyncio
+import pytest
+import threading
+
+from pass_secret_service.common.tools import MeteredExecutor, run_in_executor, SerialMixin, SingleFlight
 
 
 class TestTools:
@@ -12,3 +16,47 @@ class TestTools:
         res = [A._serial(), A._serial(), B._serial(), A._serial(), B._serial(), B._serial()]
         expect = [1, 2, 1, 3, 2, 3]
         assert res == expect
+
+    @pytest.mark.asyncio
+    async def test_single_flight(self):
+        single_flight = SingleFlight()
+        event = asyncio.Event()
+        calls = []
+
+        async def work(value):
+            calls.append(value)
+            await event.wait()
+            return value
+
+        tasks = [asyncio.ensure_future(single_flight.run("key", work, i)) for i in range(3)]
+        await asyncio.sleep(0)
+        single_flight.forget("key")
+        tasks.append(asyncio.ensure_future(single_flight.run("key", work, 3)))
+        await asyncio.sleep(0)
+        event.set()
+        assert await asyncio.gather(*tasks) == [0, 0, 0, 3]
+        assert calls == [0, 3]
+        assert single_flight.calls == 2
+        assert single_flight.shared == 2
+
+    @pytest.mark.asyncio
+    async def test_run_in_executor_pool(self):
+        def thread_name():
+            return threading.current_thread().name
+
+        assert (await run_in_executor(thread_name)()).startswith("fs")
+        assert (await run_in_executor(pool="crypto")(thread_name)()).startswith("crypto")
+
+    def test_metered_executor(self):
+        executor = MeteredExecutor("test", 1)
+        event = threading.Event()
+        futures = [executor.submit(event.wait) for i in range(3)]
+        assert executor.stats()["max_queued"] >= 2
+        event.set()
+        assert all(future.result() for future in futures)
+        stats = executor.stats()
+        assert stats["queued"] == 0
+        assert stats["running"] == 0
+        assert stats["completed"] == 3
+        assert stats["wait_max"] >= stats["wait_avg"] > 0
+        executor.shutdown()
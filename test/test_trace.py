@@ -0,0 +1,56 @@
+import json
+import pytest
+
+from dbus_next import Variant
+
+from pass_secret_service.common import trace
+from pass_secret_service.common.profiler import SamplingProfiler
+
+from .helper import get_collection, get_service
+
+
+class TestTrace:
+    @pytest.mark.asyncio
+    async def test_trace_spans(self, bus, pss_service, tmp_path):
+        trace_path = tmp_path / "trace.jsonl"
+        trace.configure_tracing(str(trace_path))
+        try:
+            service = await get_service(bus)
+            dummy, session_path = await service.call_open_session("plain", Variant("s", ""))
+            collection = await get_collection(bus, "/org/freedesktop/secrets/aliases/default")
+            item_path, prompt_path = await collection.call_create_item({}, [session_path, b"", b"password", "text/plain"], False)
+            await service.call_get_secrets([item_path], session_path)
+        finally:
+            trace.configure_tracing(None)
+        spans = [json.loads(line) for line in trace_path.read_text().splitlines()]
+        assert [span["method"] for span in spans] == [
+            "org.freedesktop.Secret.Service.OpenSession",
+            "org.freedesktop.Secret.Collection.CreateItem",
+            "org.freedesktop.Secret.Service.GetSecrets",
+        ]
+        assert all(span["sender"] == bus.unique_name for span in spans)
+        assert spans[1]["path"] == collection.path
+        assert spans[2]["run_ms"]["gpg"] > 0
+        assert spans[2]["total_ms"] >= spans[2]["run_ms"]["gpg"]
+
+    def test_chrome_trace(self, tmp_path):
+        trace_path = tmp_path / "trace.json"
+        trace.configure_tracing(str(trace_path), "chrome")
+        try:
+            with trace.span("Test.Method", None) as span:
+                span.add("fs", 0.001, 0.002)
+        finally:
+            trace.configure_tracing(None)
+        events = json.loads(trace_path.read_text().rstrip(",\n") + "]")
+        assert events[0]["name"] == "Test.Method"
+        assert events[0]["ph"] == "X"
+        assert events[0]["args"]["run_ms"] == {"fs": 2.0}
+
+    def test_sampling_profiler(self, tmp_path):
+        profiler = SamplingProfiler(str(tmp_path), interval=0.001, duration=0.05)
+        profiler.trigger()
+        profiler._thread.join()
+        (profile_path,) = tmp_path.iterdir()
+        for line in profile_path.read_text().splitlines():
+            stack, count = line.rsplit(" ", 1)
+            assert int(count) > 0